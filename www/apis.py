@@ -7,7 +7,7 @@ __author__ = 'Michael Liao'
 JSON API definition.
 '''
 
-import json, logging, inspect, functools
+import json, logging, inspect, functools, base64
 
 
 class Page(object):
@@ -32,6 +32,41 @@ class Page(object):
 
     __repr__ = __str__
 
+class Cursor(object):
+    '''
+    Opaque keyset pagination cursor: the (created_at, id) of the last item of a page.
+    '''
+    def __init__(self, created_at, id):
+        self.created_at = created_at
+        self.id = id
+
+    @classmethod
+    def after(cls, items, limit):
+        ' cursor following the last item, or None if items is not a full page. '
+        if limit <= 0 or len(items) < limit:
+            return None
+        last = items[-1]
+        return cls(last.created_at, last.id)
+
+    @classmethod
+    def decode(cls, s):
+        try:
+            created_at, id = json.loads(base64.urlsafe_b64decode(s.encode('ascii')).decode('utf-8'))
+            return cls(float(created_at), str(id))
+        except Exception as e:
+            raise APIValueError('cursor', 'Invalid cursor.')
+
+    def encode(self):
+        return base64.urlsafe_b64encode(json.dumps([self.created_at, self.id]).encode('utf-8')).decode('ascii')
+
+    def __iter__(self):
+        return iter((self.created_at, self.id))
+
+    def __str__(self):
+        return self.encode()
+
+    __repr__ = __str__
+
 class APIError(Exception):
     '''
     the base APIError which contains error(required), data(optional) and message(optional).
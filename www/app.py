@@ -9,7 +9,7 @@ async web application.
 
 import logging; logging.basicConfig(level=logging.INFO)
 
-import asyncio, os, json, time
+import asyncio, os, json, signal, time, collections.abc
 from datetime import datetime
 
 from aiohttp import web
@@ -51,6 +51,15 @@ def logger_factory(app, handler):
         return (yield from handler(request))
     return logger
 
+@asyncio.coroutine
+def orm_factory(app, handler):
+    @asyncio.coroutine
+    def unit_of_work(request):
+        # 同一个请求内按主键重复查找时直接复用已加载的对象:
+        with orm.identity_map():
+            return (yield from handler(request))
+    return unit_of_work
+
 @asyncio.coroutine
 def data_factory(app, handler):
     @asyncio.coroutine
@@ -79,9 +88,17 @@ def auth_factory(app, handler):
                 request.__user__ = user
         if request.path.startswith('/manage/') and (request.__user__ is None or not request.__user__.admin):
             return web.HTTPFound('/signin')
-        return (yield from handler(request))
+        # 同一用户写入后的一段时间内读主库(read-your-writes), 未登录的请求不固定:
+        with orm.session(request.__user__.id if request.__user__ else None):
+            return (yield from handler(request))
     return auth
 
+def json_default(o):
+    # orm.ModelRow等紧凑对象没有__dict__, 按Mapping序列化:
+    if isinstance(o, collections.abc.Mapping):
+        return dict(o)
+    return o.__dict__
+
 @asyncio.coroutine
 def response_factory(app, handler):
     @asyncio.coroutine
@@ -103,7 +120,7 @@ def response_factory(app, handler):
         if isinstance(r, dict):
             template = r.get('__template__')
             if template is None:
-                resp = web.Response(body=json.dumps(r, ensure_ascii=False, default=lambda o: o.__dict__).encode('utf-8'))
+                resp = web.Response(body=json.dumps(r, ensure_ascii=False, default=json_default).encode('utf-8'))
                 resp.content_type = 'application/json;charset=utf-8'
                 return resp
             else:
@@ -138,8 +155,11 @@ def datetime_filter(t):
 @asyncio.coroutine
 def init(loop):
     yield from orm.create_pool(loop=loop, **configs.db)
+    if configs.db.get('create_all'):
+        yield from orm.create_all()
+    yield from orm.warm_pools()
     app = web.Application(loop=loop, middlewares=[
-        logger_factory, auth_factory,response_factory
+        logger_factory, orm_factory, auth_factory,response_factory
     ])
     init_jinja2(app, filters=dict(datetime=datetime_filter))
     add_routes(app, 'handlers')
@@ -150,4 +170,11 @@ def init(loop):
 
 loop = asyncio.get_event_loop()
 loop.run_until_complete(init(loop))
-loop.run_forever()
\ No newline at end of file
+loop.add_signal_handler(signal.SIGTERM, loop.stop)
+try:
+    loop.run_forever()
+except KeyboardInterrupt:
+    pass
+finally:
+    # 写入延迟队列中的评论后关闭连接池:
+    loop.run_until_complete(orm.close_pool())
\ No newline at end of file
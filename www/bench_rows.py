@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+Row fetch benchmark on the embedded sqlite driver, run with: python bench_rows.py [rows]
+
+Compares models built from dict rows, models built from tuple rows by the generated
+constructors, and compact slot-based rows: fetch time, retained memory per row and attribute access.
+'''
+
+import asyncio, os, shutil, sys, tempfile, time, tracemalloc
+
+import orm
+from models import Blog
+
+def best(f, repeat=5):
+    ' best wall time of f() in seconds. '
+    t = None
+    for i in range(repeat):
+        start = time.perf_counter()
+        f()
+        elapsed = time.perf_counter() - start
+        if t is None or elapsed < t:
+            t = elapsed
+    return t
+
+async def main(loop, n):
+    d = tempfile.mkdtemp()
+    try:
+        await orm.create_pool(loop, driver='sqlite', db=os.path.join(d, 'bench.db'), user='', password='')
+        await orm.create_all()
+        await Blog.save_many([Blog(user_id='u', user_name='a', user_image='i', name='b%d' % i, summary='s' * 100, content='c' * 1000) for i in range(n)])
+        sql, args, columns = Blog._findAllSql(None, None, dict())
+        async def dicts():
+            return [Blog(**r) for r in await orm._select(sql, args)]
+        fetches = [
+            ('dict rows', dicts),
+            ('tuple rows', lambda: Blog.findAll()),
+            ('compact rows', lambda: Blog.findAll(compact=True)),
+        ]
+        print('%d rows, best of 5' % n)
+        print('%-14s %10s %12s %12s' % ('', 'fetch ms', 'bytes/row', 'access ns'))
+        for name, fetch in fetches:
+            await fetch() # 预热计划和构造函数缓存
+            t = None
+            for i in range(5):
+                start = time.perf_counter()
+                await fetch()
+                elapsed = time.perf_counter() - start
+                if t is None or elapsed < t:
+                    t = elapsed
+            tracemalloc.start()
+            before = tracemalloc.get_traced_memory()[0]
+            rs = await fetch()
+            size = tracemalloc.get_traced_memory()[0] - before
+            tracemalloc.stop()
+            a = best(lambda: [(r.name, r.created_at) for r in rs])
+            print('%-14s %10.1f %12d %12.1f' % (name, t * 1000, size / n, a * 1e9 / (2 * n)))
+        await orm.close_pool()
+    finally:
+        shutil.rmtree(d)
+
+if __name__ == '__main__':
+    loop = asyncio.new_event_loop()
+    loop.run_until_complete(main(loop, int(sys.argv[1]) if len(sys.argv) > 1 else 10000))
+    loop.close()
@@ -7,11 +7,30 @@ __author__ = 'Michael Liao'
 configs = {
     'debug': True,
     'db': {
+        # 'mysql' 或 'sqlite' (db为数据库文件路径或':memory:'), create_all启动时建表建索引
+        'driver': 'mysql',
+        'create_all': False,
         'host': '127.0.0.1',
         'port': 3306,
         'user': 'root',
         'password': 'root',
-        'db': 'awesome'
+        'db': 'awesome',
+        # 只读副本, 如 'replicas': {'replica1': {'host': '10.0.0.2'}}, 未列出的配置继承主库
+        'replicas': {},
+        'routing': 'round_robin',
+        'read_your_writes': 5,
+        # 超过该秒数的SQL记入慢查询日志
+        'slow_query': 0.5,
+        # 连接池在minsize和maxsize之间按平均等待时间(秒)自动伸缩, 启动时预热warm个连接
+        'minsize': 1,
+        'maxsize': 10,
+        'grow_wait': 0.005,
+        'shrink_after': 60,
+        'warm': 5,
+        # 查询结果缓存: 内存上限(字节), 新鲜期ttl秒, 过期后stale秒内先返回旧结果并后台刷新
+        'query_cache': {'budget': 16 * 1024 * 1024, 'ttl': 10, 'stale': 30},
+        # pipeline()把多条查询作为一个请求发送, 需要开启MULTI_STATEMENTS(允许叠加语句, 注意SQL注入)
+        'multi_statements': False
     },
     'session': {
         'secret': 'Awesome'
@@ -0,0 +1,331 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+Database drivers used by orm: MySQL through aiomysql, and an embedded SQLite backend
+(sqlite3 offloaded to threads) for running the app and benchmarks without a MySQL server.
+
+Both expose aiomysql's pool API (get/acquire/release/clear/size/freesize/close/wait_closed),
+connections with begin/commit/rollback/cursor(kind) and cursors with execute/fetchall/fetchmany/fetchone,
+where kind is one of 'dict', 'tuple', 'stream_dict' or 'stream_tuple', plus select_many(conn, stmts)
+running several selects on one connection for orm.pipeline().
+'''
+
+import asyncio, collections, contextlib, os, sqlite3, tempfile
+
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import aiomysql
+    from pymysql.constants import CLIENT
+except ImportError:
+    aiomysql = None
+
+class MySQLDriver(object):
+
+    name = 'mysql'
+    upsert_reports_update = True # on duplicate key update更新时影响行数为2
+
+    def __init__(self):
+        self.multi_statements = False
+        # 未安装aiomysql时仍可导入orm, 在create_pool时报错:
+        self.cursors = dict() if aiomysql is None else {
+            'dict': aiomysql.DictCursor,
+            'tuple': aiomysql.Cursor,
+            'stream_dict': aiomysql.SSDictCursor,
+            'stream_tuple': aiomysql.SSCursor
+        }
+
+    def prepare(self, sql):
+        ' convert ? placeholders to the driver paramstyle. '
+        return sql.replace('?', '%s')
+
+    async def create_pool(self, loop, kw):
+        if aiomysql is None:
+            raise ImportError('aiomysql is required by the mysql driver.')
+        # 允许一次发送多条语句, 供orm.pipeline()使用. 默认关闭: 开启后where等原始SQL片段的注入可以叠加任意语句:
+        self.multi_statements = kw.get('multi_statements', False)
+        return await aiomysql.create_pool(
+            client_flag=CLIENT.MULTI_STATEMENTS if self.multi_statements else 0,
+            host=kw.get('host', 'localhost'),
+            port=kw.get('port', 3306),
+            user=kw['user'],
+            password=kw['password'],
+            db=kw['db'],
+            charset=kw.get('charset', 'utf8'),
+            autocommit=kw.get('autocommit', True),
+            maxsize=kw.get('maxsize', 10),
+            minsize=kw.get('minsize', 1),
+            loop=loop
+        )
+
+    async def close_idle(self, pool):
+        ' close one idle connection of pool. '
+        conn = await pool.acquire()
+        conn.close()
+        pool.release(conn) # 已关闭的连接不会放回空闲队列
+
+    async def select_many(self, conn, stmts):
+        ' run (sql, args) selects on conn as one multi-statement request, returns (description, row tuples) per statement. '
+        results = []
+        async with conn.cursor(aiomysql.Cursor) as cur:
+            if self.multi_statements and len(stmts) > 1:
+                await cur.execute(';\n'.join(cur.mogrify(sql, args or ()) for sql, args in stmts))
+                while True:
+                    results.append((cur.description, list(await cur.fetchall())))
+                    if not await cur.nextset():
+                        break
+            else:
+                for sql, args in stmts:
+                    await cur.execute(sql, args or ())
+                    results.append((cur.description, list(await cur.fetchall())))
+        return results
+
+    def upsert_clause(self, cls, on_conflict, fields):
+        if on_conflict == 'update':
+            return ' on duplicate key update %s' % ', '.join(map(lambda f: '`%s`=values(`%s`)' % (f, f), fields))
+        return ' on duplicate key update `%s`=`%s`' % (cls.__primary_key__, cls.__primary_key__)
+
+    def create_table_sql(self, cls):
+        L = ['  `%s` %s not null' % (cls.__primary_key__, cls.__mappings__[cls.__primary_key__].column_type)]
+        for f in cls.__fields__:
+            L.append('  `%s` %s' % (f, cls.__mappings__[f].column_type))
+        L.append('  primary key (`%s`)' % cls.__primary_key__)
+        for index in cls.__indexes__:
+            L.append('  %skey `%s` (%s)' % ('unique ' if index.unique else '', index.name, ', '.join('`%s`' % c for c in index.columns)))
+        return 'create table if not exists `%s` (\n%s\n) engine=innodb default charset=utf8' % (cls.__table__, ',\n'.join(L))
+
+    def create_index_sql(self, cls, index):
+        return 'create %sindex `%s` on `%s` (%s)' % ('unique ' if index.unique else '', index.name, cls.__table__, ', '.join('`%s`' % c for c in index.columns))
+
+    async def index_columns(self, select, table):
+        ' dict of index name => (column names, unique) of table, select is orm.select. '
+        # MySQL 8返回大写的列名(INDEX_NAME), 用别名固定:
+        rs = await select('select `index_name` as `index_name`, `column_name` as `column_name`, `non_unique` as `non_unique` from information_schema.statistics where `table_schema`=database() and `table_name`=? order by `index_name`, `seq_in_index`', [table])
+        indexes = dict()
+        for r in rs:
+            indexes.setdefault(r['index_name'], ([], not int(r['non_unique'])))[0].append(r['column_name'])
+        return indexes
+
+class SQLiteCursor(object):
+
+    def __init__(self, conn, kind):
+        self._conn = conn
+        self._kind = kind
+        self._cur = None
+        self._rows = []
+        self.rowcount = -1
+        self.description = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        if self._cur is not None:
+            await self._conn._run(self._cur.close)
+            self._cur = None
+
+    def _row(self, r):
+        if self._kind.endswith('dict'):
+            return dict(zip((d[0] for d in self.description), r))
+        return r
+
+    def _execute(self, sql, args):
+        # 在连接的线程中执行, 非流式游标一并取回全部结果:
+        if self._cur is not None:
+            self._cur.close()
+            self._cur = None
+        cur = self._conn._db.execute(sql, args or ())
+        self.rowcount = cur.rowcount
+        if self._kind.startswith('stream'):
+            self._cur = cur
+            return [], cur.description
+        rows = cur.fetchall() if cur.description else []
+        cur.close()
+        return rows, cur.description
+
+    async def execute(self, sql, args=()):
+        rows, self.description = await self._conn._run(self._execute, sql, args)
+        self._rows = list(map(self._row, rows))
+        return self.rowcount
+
+    async def fetchall(self):
+        if self._cur is not None:
+            return list(map(self._row, await self._conn._run(self._cur.fetchall)))
+        rs, self._rows = self._rows, []
+        return rs
+
+    async def fetchmany(self, size=1):
+        if self._cur is not None:
+            return list(map(self._row, await self._conn._run(self._cur.fetchmany, size)))
+        rs, self._rows = self._rows[:size], self._rows[size:]
+        return rs
+
+    async def fetchone(self):
+        rs = await self.fetchmany(1)
+        return rs[0] if rs else None
+
+class SQLiteConnection(object):
+    '''
+    A sqlite3 connection pinned to its own worker thread.
+    '''
+    def __init__(self, loop, database):
+        self._loop = loop
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._database = database
+        self._db = None
+
+    def _run(self, fn, *args):
+        return self._loop.run_in_executor(self._executor, fn, *args)
+
+    def _connect(self):
+        db = sqlite3.connect(self._database, timeout=30, isolation_level=None, check_same_thread=False)
+        db.execute('pragma journal_mode=wal')
+        return db
+
+    async def connect(self):
+        self._db = await self._run(self._connect)
+        return self
+
+    def cursor(self, kind='dict'):
+        return SQLiteCursor(self, kind)
+
+    async def begin(self):
+        await self._run(self._db.execute, 'begin')
+
+    async def commit(self):
+        await self._run(self._db.execute, 'commit')
+
+    async def rollback(self):
+        await self._run(self._db.execute, 'rollback')
+
+    async def close(self):
+        await self._run(self._db.close)
+        self._executor.shutdown(wait=False)
+
+class SQLitePool(object):
+    '''
+    aiomysql style pool of SQLiteConnection.
+    '''
+    def __init__(self, loop, database, minsize=1, maxsize=10):
+        self._loop = loop
+        self.minsize = minsize
+        self.maxsize = maxsize
+        # ':memory:'改用临时文件: 共享缓存的内存数据库是表级锁, 并发读写时立即报database table is locked,
+        # WAL模式的文件数据库读写不互相阻塞, 关闭连接池时删除:
+        self._temp = database == ':memory:'
+        if self._temp:
+            fd, database = tempfile.mkstemp(prefix='awesome-', suffix='.db')
+            os.close(fd)
+        self._database = database
+        self._free = collections.deque()
+        self._used = set()
+        self._sem = asyncio.Semaphore(maxsize)
+
+    @property
+    def size(self):
+        return len(self._free) + len(self._used)
+
+    @property
+    def freesize(self):
+        return len(self._free)
+
+    async def acquire(self):
+        await self._sem.acquire()
+        try:
+            conn = self._free.pop() if self._free else await SQLiteConnection(self._loop, self._database).connect()
+        except BaseException:
+            self._sem.release()
+            raise
+        self._used.add(conn)
+        return conn
+
+    def release(self, conn):
+        self._used.discard(conn)
+        self._free.append(conn)
+        self._sem.release()
+
+    @contextlib.asynccontextmanager
+    async def get(self):
+        conn = await self.acquire()
+        try:
+            yield conn
+        finally:
+            self.release(conn)
+
+    async def clear(self):
+        while len(self._free) > self.minsize:
+            await self._free.popleft().close()
+
+    async def close_idle(self):
+        if self._free:
+            await self._free.popleft().close()
+
+    def close(self):
+        pass
+
+    async def wait_closed(self):
+        while self._free:
+            await self._free.popleft().close()
+        if self._temp:
+            for suffix in ('', '-wal', '-shm'):
+                if os.path.exists(self._database + suffix):
+                    os.remove(self._database + suffix)
+
+class SQLiteDriver(object):
+
+    name = 'sqlite'
+    upsert_reports_update = False
+    cursors = dict(dict='dict', tuple='tuple', stream_dict='stream_dict', stream_tuple='stream_tuple')
+
+    def prepare(self, sql):
+        return sql
+
+    async def create_pool(self, loop, kw):
+        pool = SQLitePool(loop or asyncio.get_event_loop(), kw.get('db', ':memory:'), kw.get('minsize', 1), kw.get('maxsize', 10))
+        for i in range(pool.minsize):
+            pool.release(await pool.acquire())
+        return pool
+
+    async def close_idle(self, pool):
+        await pool.close_idle()
+
+    async def select_many(self, conn, stmts):
+        # 进程内没有网络往返, 在连接的线程中依次执行:
+        def run():
+            results = []
+            for sql, args in stmts:
+                cur = conn._db.execute(sql, args or ())
+                results.append((cur.description, cur.fetchall()))
+                cur.close()
+            return results
+        return await conn._run(run)
+
+    def upsert_clause(self, cls, on_conflict, fields):
+        if on_conflict == 'update':
+            return ' on conflict do update set %s' % ', '.join(map(lambda f: '`%s`=excluded.`%s`' % (f, f), fields))
+        return ' on conflict do nothing'
+
+    def create_table_sql(self, cls):
+        # sqlite不支持在create table中声明普通索引, 由create_index_sql单独创建:
+        L = ['  `%s` %s not null primary key' % (cls.__primary_key__, cls.__mappings__[cls.__primary_key__].column_type)]
+        for f in cls.__fields__:
+            L.append('  `%s` %s' % (f, cls.__mappings__[f].column_type))
+        return 'create table if not exists `%s` (\n%s\n)' % (cls.__table__, ',\n'.join(L))
+
+    def create_index_sql(self, cls, index):
+        # sqlite的索引名在整个数据库内唯一:
+        return 'create %sindex if not exists `%s_%s` on `%s` (%s)' % ('unique ' if index.unique else '', cls.__table__, index.name, cls.__table__, ', '.join('`%s`' % c for c in index.columns))
+
+    async def index_columns(self, select, table):
+        indexes = dict()
+        for r in await select('pragma index_list(`%s`)' % table, []):
+            indexes[r['name']] = ([c['name'] for c in await select('pragma index_info(`%s`)' % r['name'], [])], bool(r['unique']))
+        return indexes
+
+def get_driver(name):
+    if name == 'mysql':
+        return MySQLDriver()
+    if name == 'sqlite':
+        return SQLiteDriver()
+    raise ValueError('Invalid database driver: %s' % name)
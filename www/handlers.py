@@ -7,10 +7,11 @@ __author__ = 'Michael Liao'
 
 import re, time, json, logging, hashlib, base64, asyncio
 from aiohttp import web
-from apis import APIValueError, APIResourceNotFoundError,APIError,APIPermissionError,Page
+from apis import APIValueError, APIResourceNotFoundError,APIError,APIPermissionError,Page,Cursor
 from coroweb import get, post
 
 import markdown2
+import orm
 from models import User, Comment, Blog, next_id
 from config import configs
 COOKIE_NAME = 'awesession'
@@ -48,7 +49,9 @@ def cookie2user(cookie_str):
         if sha1 != hashlib.sha1(s.encode('utf-8')).hexdigest():
             logging.info('invalid sha1')
             return None
-        user.passwd = '******'
+        # 身份映射中的实例会被同一请求的find()复用, 在副本上隐藏密码且不标记为修改:
+        user = user.copy()
+        dict.__setitem__(user, 'passwd', '******')
         return user
     except Exception as e:
         logging.exception(e)
@@ -63,7 +66,7 @@ def index(request):
     #     Blog(id='2', name='Something New', summary=summary, created_at=time.time()-3600),
     #     Blog(id='3', name='Learn Swift', summary=summary, created_at=time.time()-7200)
     # ]
-    blogs=yield from Blog.findAll(orderBy='created_at desc')
+    blogs=yield from Blog.findAll(orderBy='created_at desc',compact=True,cache=True)
     return {
         '__template__': 'blogs.html',
         'blogs': blogs,
@@ -146,13 +149,16 @@ def api_register_user(*, email, name, passwd):
         raise APIValueError('email')
     if not passwd or not _RE_SHA1.match(passwd):
         raise APIValueError('passwd')
-    users = yield from User.findAll('email=?', [email])
+    # 已有部署不一定建了email唯一索引, 先查重; 有唯一索引时下面的插入再挡住并发注册:
+    users = yield from User.findAll('email=?', [email], limit=1)
     if len(users) > 0:
         raise APIError('register:failed', 'email', 'Email is already in use.')
     uid = next_id()
     sha1_passwd = '%s:%s' % (uid, passwd)
     user = User(id=uid, name=name.strip(), email=email, passwd=hashlib.sha1(sha1_passwd.encode('utf-8')).hexdigest(), image='http://www.gravatar.com/avatar/%s?d=mm&s=120' % hashlib.md5(email.encode('utf-8')).hexdigest())
-    yield from user.save()
+    rows = yield from user.save(on_conflict='ignore')
+    if rows == 0:
+        raise APIError('register:failed', 'email', 'Email is already in use.')
     # make session cookie:
     r = web.Response()
     r.set_cookie(COOKIE_NAME, user2cookie(user, 86400), max_age=86400, httponly=True)
@@ -212,18 +218,32 @@ def api_delete_comment(*,id,request):
     yield from comment.remove()
     return dict(id=id)   
 
+@post('/api/comments/delete')                   #bulk delete comments api
+@asyncio.coroutine
+def api_delete_comments(*,ids,request):
+    check_admin(request)
+    if not isinstance(ids,list) or not ids:
+        raise APIValueError('ids','ids must be a non-empty list.')
+    rows=yield from Comment.remove_many(ids)
+    return dict(ids=ids,rows=rows)
+
 @get('/api/comments')                              #comments  api
 @asyncio.coroutine
-def api_get_comments(*,page='1'):
+def api_get_comments(*,page='1',cursor=None):
+    if cursor is not None:
+        comments=yield from Comment.findAll(orderBy=_SEEK_ORDER,after=get_cursor(cursor),limit=_PAGE_SIZE,compact=True)
+        return dict(comments=comments,cursor=next_cursor(comments,_PAGE_SIZE))
     page_index=get_page_index(page)
-    num=yield from Comment.findNumber('count(id)')
+    # 计数和当页数据一次往返取回, 页码超出范围时丢弃数据:
+    with orm.pipeline():
+        num,comments=yield from asyncio.gather(Comment.count(),Comment.findAll(orderBy=_SEEK_ORDER,limit=(_PAGE_SIZE*(page_index-1),_PAGE_SIZE),compact=True))
     p=Page(num,page_index)
     if num==0:
         return dict(page=p,comments=())
-    comments=yield from Comment.findAll(orderBy='created_at desc',limit=(p.offset,p\
-        .limit))
+    if p.limit==0:
+        comments=[]
     logging.info('Test',comments)
-    return dict(page=p,comments=comments)
+    return dict(page=p,comments=comments,cursor=next_cursor(comments,p.limit))
 
 
 
@@ -239,7 +259,7 @@ def api_add_comment(*,id,content,request):
         raise APIValueError('comment_content','content cannot be empty.')
     comment=Comment(user_id=request.__user__.id,blog_id=id,user_name=request.__user__.name,\
         user_image=request.__user__.image,content=content)
-    yield from comment.save()
+    yield from comment.save_later()
     return comment
 
 @get('/manage/users')
@@ -252,15 +272,20 @@ def get_users(*,page='1',request):
 
 @get('/api/users')
 @asyncio.coroutine
-def api_get_users(*,page,request):
+def api_get_users(*,page='1',cursor=None,request):
     check_admin(request)
+    if cursor is not None:
+        users=yield from User.findAll(orderBy=_SEEK_ORDER,after=get_cursor(cursor),limit=_PAGE_SIZE)
+        return dict(users=users,cursor=next_cursor(users,_PAGE_SIZE))
     page_index=get_page_index(page)
-    num=yield from User.findNumber('count(id)')
+    with orm.pipeline():
+        num,users=yield from asyncio.gather(User.count(),User.findAll(orderBy=_SEEK_ORDER,limit=(_PAGE_SIZE*(page_index-1),_PAGE_SIZE)))
     p=Page(num,page_index)
     if num==0:
         return dict(page=p,users=())
-    users=yield from User.findAll(orderBy='created_at desc',limit=(p.offset,p.limit))
-    return dict(page=p,users=users)
+    if p.limit==0:
+        users=[]
+    return dict(page=p,users=users,cursor=next_cursor(users,p.limit))
 
 @post('/api/blogs/{id}/delete')                         #删除blog api.
 @asyncio.coroutine
@@ -273,8 +298,8 @@ def api_delete_blog(*,id,request):
 @get('/blog/{id}')                      #查看blog
 @asyncio.coroutine
 def get_blog(*,id,request):
-    blog = yield from Blog.find(id)
-    comments = yield from Comment.findAll('blog_id=?', [id], orderBy='created_at desc')
+    with orm.pipeline():
+        blog, comments = yield from asyncio.gather(Blog.find(id), Blog.comments.find(id, cache=True))
     for c in comments:
         c.html_content = text2html(c.content)
     blog.html_content = markdown2.markdown(blog.content)
@@ -308,6 +333,12 @@ def api_create_blog(request, *, name, summary, content):
     yield from blog.save()
     return blog
 
+@get('/api/stats')                                               #orm统计: SQL延迟直方图、慢查询等
+@asyncio.coroutine
+def api_stats(request):
+    check_admin(request)
+    return dict(queries=orm.query_stats(), pools=orm.pool_stats(), plans=orm.plan_stats(), caches=orm.cache_stats(), counters=orm.counter_stats(), batches=orm.batch_stats(), query_cache=orm.query_cache_stats(), writers=orm.writer_stats())
+
 def check_admin(request):
     if request.__user__ is None or not request.__user__.admin:
         raise APIPermissionError()
@@ -322,20 +353,39 @@ def get_page_index(page_str):
         p = 1
     return p
 
+# 键集分页: 按(created_at, id)倒序, cursor为空字符串表示第一页
+_SEEK_ORDER = 'created_at desc, id desc'
+_PAGE_SIZE = 10
+
+def get_cursor(cursor_str):
+    if not cursor_str:
+        return None
+    return Cursor.decode(cursor_str)
+
+def next_cursor(items, limit):
+    c = Cursor.after(items, limit)
+    return c.encode() if c else None
+
 def text2html(text):
     lines = map(lambda s: '<p>%s</p>' % s.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;'), filter(lambda s: s.strip() != '', text.split('\n')))
     return ''.join(lines)
 
 @get('/api/blogs')
 @asyncio.coroutine                                                  #打开管理blogs时请求的url,返回所有blogs和页码
-def api_blogs(*, page='1'):
+def api_blogs(*, page='1', cursor=None):
+    if cursor is not None:
+        blogs = yield from Blog.findAll(orderBy=_SEEK_ORDER, after=get_cursor(cursor), limit=_PAGE_SIZE, compact=True)
+        return dict(blogs=blogs, cursor=next_cursor(blogs, _PAGE_SIZE))
     page_index = get_page_index(page)
-    num = yield from Blog.findNumber('count(id)')
+    # 计数和当页数据一次往返取回, 页码超出范围时丢弃数据:
+    with orm.pipeline():
+        num, blogs = yield from asyncio.gather(Blog.count(), Blog.findAll(orderBy=_SEEK_ORDER, limit=(_PAGE_SIZE * (page_index - 1), _PAGE_SIZE), compact=True, cache=True))
     p = Page(num, page_index)
     if num == 0:
         return dict(page=p, blogs=())
-    blogs = yield from Blog.findAll(orderBy='created_at desc', limit=(p.offset, p.limit))
-    return dict(page=p, blogs=blogs)
+    if p.limit == 0:
+        blogs = []
+    return dict(page=p, blogs=blogs, cursor=next_cursor(blogs, p.limit))
 
 @get('/manage/blogs')                                               # 管理全部blogs（edit,delete）            
 def manage_blogs(*, page='1',request):
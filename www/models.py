@@ -9,13 +9,17 @@ __author__ = 'Michael Liao'
 
 import time, uuid
 
-from orm import Model, StringField, BooleanField, FloatField, TextField
+from orm import Model, Index, HasMany, BelongsTo, StringField, BooleanField, FloatField, TextField
 
 def next_id():
     return '%015d%s000' % (int(time.time() * 1000), uuid.uuid4().hex)
 
 class User(Model):
     __table__ = 'users'
+    __cache__ = dict(size=1000, ttl=60)
+    __batch__ = True
+    __counter__ = dict(reconcile=60)
+    __indexes__ = [Index('email', unique=True), Index('created_at')]
 
     id = StringField(primary_key=True, default=next_id, ddl='varchar(50)')
     email = StringField(ddl='varchar(50)')
@@ -27,6 +31,11 @@ class User(Model):
 
 class Blog(Model):
     __table__ = 'blogs'
+    __cache__ = dict(size=1000, ttl=300)
+    __deferred__ = ['content']
+    __batch__ = True
+    __counter__ = dict(reconcile=60)
+    __indexes__ = [Index('created_at')]
 
     id = StringField(primary_key=True, default=next_id, ddl='varchar(50)')
     user_id = StringField(ddl='varchar(50)')
@@ -39,6 +48,9 @@ class Blog(Model):
 
 class Comment(Model):
     __table__ = 'comments'
+    __counter__ = dict(reconcile=60)
+    __write_behind__ = dict(batch_size=100, interval=0.05, maxsize=10000, spill='comments.spill')
+    __indexes__ = [Index('blog_id', 'created_at'), Index('created_at')]
 
     id = StringField(primary_key=True, default=next_id, ddl='varchar(50)')
     blog_id = StringField(ddl='varchar(50)')
@@ -46,4 +58,9 @@ class Comment(Model):
     user_name = StringField(ddl='varchar(50)')
     user_image = StringField(ddl='varchar(500)')
     content = TextField()
-    created_at = FloatField(default=time.time)
\ No newline at end of file
+    created_at = FloatField(default=time.time)
+
+Blog.user = BelongsTo(User, 'user_id')
+Blog.comments = HasMany(Comment, 'blog_id', orderBy='created_at desc')
+Comment.user = BelongsTo(User, 'user_id')
+Comment.blog = BelongsTo(Blog, 'blog_id')
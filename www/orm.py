@@ -3,58 +3,512 @@
 
 __author__ = 'Michael Liao'
 
-import asyncio, logging
+import asyncio, logging, contextlib, contextvars, collections, collections.abc, functools, json, os, re, sys, time
 
-import aiomysql
+from drivers import get_driver
 
 def log(sql, args=()):
-    logging.info('SQL: %s' % sql)
+    logging.debug('SQL: %s', sql)
+
+_RE_VALUES = re.compile(r'\(((%s|\?)(?:, \2)*)\)(?:, \(\1\))+')
+_RE_ARGS = re.compile(r'(%s|\?)(?:, \1)+')
+
+@functools.lru_cache(maxsize=1024)
+def normalize(sql):
+    ' collapse variable-length placeholder lists, so chunked in (...) and multi-row values share one entry. '
+    return _RE_ARGS.sub(r'\1, ...', _RE_VALUES.sub(r'(\1), ...', sql))
+
+class QueryStats(object):
+    '''
+    Per normalized statement latency histograms, row counts and pool wait time, plus a slow query log.
+    '''
+    BUCKETS = (0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1.0, 2.0, 5.0) # 秒
+
+    def __init__(self, slow=0.5, slow_log_size=100, max_statements=1000):
+        self.slow = slow
+        self.max_statements = max_statements
+        self.slow_log = collections.deque(maxlen=slow_log_size)
+        self._stmts = dict()
+
+    def record(self, sql, elapsed, rows, wait):
+        key = normalize(sql)
+        s = self._stmts.get(key)
+        if s is None:
+            if len(self._stmts) >= self.max_statements:
+                key = '(other)'
+                s = self._stmts.get(key)
+            if s is None:
+                s = self._stmts[key] = dict(count=0, time=0.0, max=0.0, rows=0, wait=0.0, histogram=[0] * (len(self.BUCKETS) + 1))
+        s['count'] += 1
+        s['time'] += elapsed
+        s['rows'] += rows
+        s['wait'] += wait
+        if elapsed > s['max']:
+            s['max'] = elapsed
+        i = 0
+        for b in self.BUCKETS:
+            if elapsed <= b:
+                break
+            i += 1
+        s['histogram'][i] += 1
+        if self.slow is not None and elapsed >= self.slow:
+            logging.warning('slow query: %.3fs (wait %.3fs, rows %s): %s' % (elapsed, wait, rows, sql))
+            self.slow_log.append(dict(sql=sql, time=elapsed, wait=wait, rows=rows, at=time.time()))
+
+    def percentile(self, histogram, q):
+        ' upper bound in seconds of the bucket holding quantile q, None for the overflow bucket. '
+        n = sum(histogram)
+        if n == 0:
+            return 0.0
+        seen = 0
+        for i, c in enumerate(histogram):
+            seen += c
+            if seen >= q * n:
+                return self.BUCKETS[i] if i < len(self.BUCKETS) else None
+        return None
+
+    def stats(self):
+        L = dict()
+        for sql, s in self._stmts.items():
+            d = dict(s)
+            d['histogram'] = list(s['histogram'])
+            d['avg'] = s['time'] / s['count']
+            d['p50'] = self.percentile(s['histogram'], 0.5)
+            d['p99'] = self.percentile(s['histogram'], 0.99)
+            L[sql] = d
+        return dict(buckets=list(self.BUCKETS), slow=self.slow, statements=L, slow_log=list(self.slow_log))
+
+    def reset(self):
+        self._stmts.clear()
+        self.slow_log.clear()
+
+_stats = QueryStats()
+
+def query_stats():
+    ' per statement latency histograms, rows, pool wait and the slow query log. '
+    return _stats.stats()
+
+def dump_stats(**kw):
+    ' query_stats() as json. '
+    return json.dumps(query_stats(), **kw)
+
+class PoolManager(object):
+    '''
+    Wraps a driver pool: tracks acquire wait time and connections in use, and grows or shrinks
+    the number of connections allowed in use between minsize and maxsize based on observed wait.
+    '''
+    def __init__(self, name, pool, minsize=1, maxsize=10, grow_wait=0.005, shrink_after=60):
+        self.name = name
+        self.pool = pool
+        self.minsize = minsize
+        self.maxsize = maxsize
+        self.grow_wait = grow_wait
+        self.shrink_after = shrink_after
+        self.limit = minsize
+        self.in_use = 0
+        self.waiting = 0
+        self.peak = 0
+        self.acquires = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self.avg_wait = 0.0 # 指数移动平均
+        self._busy_at = time.time()
+        self._cond = asyncio.Condition()
+
+    @contextlib.asynccontextmanager
+    async def get(self):
+        start = time.perf_counter()
+        async with self._cond:
+            self.waiting += 1
+            try:
+                while self.in_use >= self.limit:
+                    if self.limit >= self.maxsize:
+                        await self._cond.wait()
+                        continue
+                    try:
+                        await asyncio.wait_for(self._cond.wait(), self.grow_wait)
+                    except asyncio.TimeoutError:
+                        # 在等待路径上扩容, 持有连接的协程再申请连接时不会死锁:
+                        if self.in_use >= self.limit:
+                            self._grow()
+            finally:
+                self.waiting -= 1
+            self.in_use += 1
+            self.peak = max(self.peak, self.in_use)
+        try:
+            async with self.pool.get() as conn:
+                await self._observe(time.perf_counter() - start)
+                yield conn
+        finally:
+            await self._release()
+
+    async def _observe(self, wait):
+        self.acquires += 1
+        self.wait_total += wait
+        self.wait_max = max(self.wait_max, wait)
+        self.avg_wait = self.avg_wait * 0.9 + wait * 0.1
+        if self.avg_wait > self.grow_wait and self.limit < self.maxsize:
+            async with self._cond:
+                self._grow()
+                self._cond.notify()
+
+    def _grow(self):
+        self.limit += 1
+        self.avg_wait = 0.0
+        self._busy_at = time.time()
+        logging.info('grow pool %s to %s connections.' % (self.name, self.limit))
+
+    async def _release(self):
+        async with self._cond:
+            self.in_use -= 1
+            self._cond.notify()
+        now = time.time()
+        if self.in_use * 2 >= self.limit or self.waiting:
+            self._busy_at = now
+        elif self.limit > self.minsize and now - self._busy_at > self.shrink_after:
+            self.limit -= 1
+            self._busy_at = now
+            logging.info('shrink pool %s to %s connections.' % (self.name, self.limit))
+            # 在后台关闭一个多余的空闲连接, 不阻塞当前请求:
+            asyncio.ensure_future(self._trim())
+
+    async def _trim(self):
+        if self.pool.freesize and self.pool.size > self.limit:
+            await _driver.close_idle(self.pool)
+
+    async def warm(self, n=None):
+        ' open n connections (default the current limit) ahead of traffic. '
+        n = min(n or self.limit, self.maxsize)
+        self.limit = max(self.limit, n)
+        conns = [await self.pool.acquire() for i in range(n)]
+        for conn in conns:
+            self.pool.release(conn)
+
+    def stats(self):
+        return dict(limit=self.limit, minsize=self.minsize, maxsize=self.maxsize, in_use=self.in_use, waiting=self.waiting,
+                    peak=self.peak, acquires=self.acquires, avg_wait=self.avg_wait, wait_max=self.wait_max,
+                    wait_total=self.wait_total, size=self.pool.size, free=self.pool.freesize)
+
+    def close(self):
+        self.pool.close()
+
+    async def wait_closed(self):
+        await self.pool.wait_closed()
+
+class Router(object):
+    '''
+    Routes reads to replica pools (round_robin or least_busy) and writes to the primary pool.
+    Reads of a session that wrote within the last `pin` seconds stay on the primary.
+    '''
+    def __init__(self, primary, replicas=None, policy='round_robin', pin=5, max_sessions=10000):
+        if policy not in ('round_robin', 'least_busy'):
+            raise ValueError('Invalid routing policy: %s' % policy)
+        self.primary = primary
+        self.replicas = replicas or dict()
+        self.policy = policy
+        self.pin = pin
+        self.max_sessions = max_sessions
+        self._pools = list(self.replicas.values())
+        self._next = 0
+        self._writes = collections.OrderedDict()
+
+    def pools(self):
+        return [self.primary] + self._pools
+
+    def read(self):
+        if not self._pools or self._pinned():
+            return self.primary
+        if self.policy == 'least_busy':
+            return min(self._pools, key=lambda p: p.in_use)
+        self._next = (self._next + 1) % len(self._pools)
+        return self._pools[self._next]
+
+    def write(self):
+        key = _session.get()
+        if key is not None and self.pin:
+            self._writes[key] = time.time()
+            self._writes.move_to_end(key)
+            while len(self._writes) > self.max_sessions:
+                self._writes.popitem(last=False)
+        return self.primary
+
+    def _pinned(self):
+        key = _session.get()
+        if key is None:
+            return False
+        t = self._writes.get(key)
+        return t is not None and time.time() - t < self.pin
+
+_session = contextvars.ContextVar('session', default=None)
+
+@contextlib.contextmanager
+def session(key):
+    ' read-your-writes scope: reads after a write with the same key go to the primary. '
+    token = _session.set(key)
+    try:
+        yield
+    finally:
+        _session.reset(token)
+
+async def _create_manager(loop, name, kw):
+    pool = await _driver.create_pool(loop, kw)
+    return PoolManager(name, pool, kw.get('minsize', 1), kw.get('maxsize', 10), kw.get('grow_wait', 0.005), kw.get('shrink_after', 60))
+
+async def warm_pools(n=None):
+    ' pre-open n connections (default configured warm size) in every pool. '
+    for m in __router.pools():
+        await m.warm(n or __warm)
+
+def pool_stats():
+    ' acquire wait and in-use counts of every pool. '
+    return dict((m.name, m.stats()) for m in __router.pools())
 
 async def create_pool(loop, **kw):
+    '''
+    create the primary pool and optional named read replicas, driver='mysql' (aiomysql) or 'sqlite' (db is a file or :memory:),
+    replicas=dict(name=dict(host=...)) (other settings inherited from the primary),
+    routing='round_robin' or 'least_busy', read_your_writes=seconds reads stay on the primary after a write
+    (with replicas the caches also skip rows read within that many seconds of a write to them),
+    slow_query=seconds above which statements go to the slow query log (None disables it),
+    minsize/maxsize bound each pool, which grows while the average acquire wait exceeds grow_wait seconds
+    and shrinks after shrink_after idle seconds; warm=connections warm_pools() opens at startup,
+    query_cache=dict(budget=bytes, ttl=seconds, stale=seconds) configures select(..., cache=True),
+    multi_statements=True lets pipeline() send its selects as one request (mysql), otherwise they run one by one on the shared connection.
+    '''
     logging.info('create database connection pool...')
-    global __pool
-    __pool = await aiomysql.create_pool(
-        host=kw.get('host', 'localhost'),
-        port=kw.get('port', 3306),
-        user=kw['user'],
-        password=kw['password'],
-        db=kw['db'],
-        charset=kw.get('charset', 'utf8'),
-        autocommit=kw.get('autocommit', True),
-        maxsize=kw.get('maxsize', 10),
-        minsize=kw.get('minsize', 1),
-        loop=loop
-    )
+    global __router, _driver
+    _driver = get_driver(kw.get('driver', 'mysql'))
+    _plans.clear()
+    primary = await _create_manager(loop, 'primary', kw)
+    replicas = dict()
+    for name, r in (kw.get('replicas') or dict()).items():
+        logging.info('create replica connection pool: %s' % name)
+        ra = dict(kw)
+        ra.update(r)
+        replicas[name] = await _create_manager(loop, name, ra)
+    __router = Router(primary, replicas, kw.get('routing', 'round_robin'), kw.get('read_your_writes', 5))
+    _stats.slow = kw.get('slow_query', _stats.slow)
+    global _query_cache
+    _query_cache = QueryCache(**kw.get('query_cache', {}))
+    # 有从库时, 写入后read_your_writes秒内读到的可能是旧数据, 不放入缓存:
+    hold = kw.get('read_your_writes', 5) if replicas else 0
+    _query_cache.hold = hold
+    for m in _models:
+        if m.__rowcache__ is not None:
+            m.__rowcache__.hold = hold
+    for m in _models:
+        if m.__writer__ is not None:
+            await m.__writer__.start()
+    global __warm
+    __warm = kw.get('warm', None)
 
 async def close_pool():
     '''异步关闭连接池'''
     logging.info('close database connection pool...')
-    global __pool
-    __pool.close()
-    await __pool.wait_closed()
+    for m in _models:
+        if m.__writer__ is not None:
+            await m.__writer__.close()
+    global __router
+    for pool in __router.pools():
+        pool.close()
+        await pool.wait_closed()
+
+
+class Transaction(object):
+    '''
+    A connection pinned by transaction() for every orm call made inside it.
+    '''
+    def __init__(self, conn):
+        self.conn = conn
+        self._callbacks = []
+
+    def after_commit(self, fn):
+        ' call fn() once the transaction has committed. '
+        self._callbacks.append(fn)
+
+    async def __aenter__(self):
+        return self.conn
+
+    async def __aexit__(self, exc_type, exc, tb):
+        pass
+
+_transaction = contextvars.ContextVar('transaction', default=None)
+
+@contextlib.asynccontextmanager
+async def transaction():
+    '''
+    async with transaction() as tx: pins one primary connection for nested find/save/update/remove calls
+    and commits once on exit (rolls back on error). nested transaction() calls join the outer one.
+    '''
+    tx = _transaction.get()
+    if tx is not None:
+        yield tx
+        return
+    async with __router.write().get() as conn:
+        await conn.begin()
+        tx = Transaction(conn)
+        token = _transaction.set(tx)
+        try:
+            yield tx
+            await conn.commit()
+        except BaseException as e:
+            await conn.rollback()
+            raise
+        finally:
+            _transaction.reset(token)
+    for fn in tx._callbacks:
+        fn()
+
+def _reader():
+    tx = _transaction.get()
+    return tx if tx is not None else __router.read().get()
 
+def _pinned():
+    ' True while the current session reads from the primary after a write. '
+    return __router._pinned()
 
-async def select(sql, args, size=None):
+def _writer():
+    tx = _transaction.get()
+    return tx if tx is not None else __router.write().get()
+
+async def select(sql, args, size=None, cache=False):
+    ' cache=True serves the rows from the query cache, treat them as read-only. '
+    return await _select(_driver.prepare(sql), args, size, cache=cache)
+
+async def _select(sql, args, size=None, cursor='dict', cache=False):
+    ' select with driver-ready sql (placeholders already converted), cursor=\'tuple\' returns plain tuples. '
+    if cache and _transaction.get() is None:
+        key = (sql, tuple(args or ()), size, cursor)
+        return await _query_cache.get(key, read_tables(sql), lambda: _select(sql, args, size, cursor))
+    p = _pipeline.get()
+    if p is not None and _transaction.get() is None:
+        return await p.add(sql, args, size, cursor)
     log(sql, args)
-    global __pool
-    async with __pool.get() as conn:
-        async with conn.cursor(aiomysql.DictCursor) as cur:
-            await cur.execute(sql.replace('?', '%s'), args or ())
+    start = time.perf_counter()
+    async with _reader() as conn:
+        acquired = time.perf_counter()
+        async with conn.cursor(_driver.cursors[cursor]) as cur:
+            await cur.execute(sql, args or ())
             if size:
                 rs = await cur.fetchmany(size)
             else:
                 rs = await cur.fetchall()
-        logging.info('rows returned: %s' % len(rs))
+        _stats.record(sql, time.perf_counter() - acquired, len(rs), acquired - start)
         return rs
 
+class Pipeline(object):
+    '''
+    Selects made inside pipeline() within the same two event loop ticks, sent together on one connection
+    (one multi-statement request on MySQL) with each result set returned to its caller.
+    '''
+    def __init__(self):
+        self.round_trips = 0
+        self.statements = 0
+        self._context = contextvars.copy_context()
+        self._pending = []
+
+    async def add(self, sql, args, size, cursor):
+        loop = asyncio.get_event_loop()
+        if not self._pending:
+            # 在创建pipeline时的上下文中发送, 沿用其会话:
+            loop.call_soon(self._defer, loop, context=self._context)
+        fut = loop.create_future()
+        self._pending.append((sql, args, size, cursor, fut))
+        return await asyncio.shield(fut)
+
+    def _defer(self, loop):
+        # 再等一个tick, 让缓存/计数器通过ensure_future发起的查询也加入本批:
+        loop.call_soon(self._dispatch)
+
+    def _dispatch(self):
+        pending, self._pending = self._pending, []
+        asyncio.ensure_future(self._fetch(pending))
+
+    async def _fetch(self, pending):
+        for sql, args, size, cursor, fut in pending:
+            log(sql, args)
+        start = time.perf_counter()
+        try:
+            async with _reader() as conn:
+                acquired = time.perf_counter()
+                results = await _driver.select_many(conn, [(sql, args) for sql, args, size, cursor, fut in pending])
+        except Exception as e:
+            for p in pending:
+                if not p[4].done():
+                    p[4].set_exception(e)
+            return
+        except BaseException as e:
+            for p in pending:
+                p[4].cancel()
+            raise
+        elapsed = time.perf_counter() - acquired
+        self.round_trips += 1
+        self.statements += len(pending)
+        for (sql, args, size, cursor, fut), (description, rs) in zip(pending, results):
+            if size:
+                rs = rs[:size]
+            if cursor == 'dict':
+                names = [d[0] for d in description]
+                rs = [dict(zip(names, r)) for r in rs]
+            else:
+                rs = list(rs)
+            _stats.record(sql, elapsed, len(rs), acquired - start)
+            if not fut.done():
+                fut.set_result(rs)
+
+_pipeline = contextvars.ContextVar('pipeline', default=None)
+
+@contextlib.contextmanager
+def pipeline():
+    '''
+    with pipeline(): selects started together, e.g. by asyncio.gather(Blog.count(), Blog.findAll(...)),
+    share one connection and one round trip. selects inside transaction() are not pipelined.
+    '''
+    p = Pipeline()
+    token = _pipeline.set(p)
+    try:
+        yield p
+    finally:
+        _pipeline.reset(token)
+
+def iter_select(sql, args, batch_size=1000):
+    ' stream rows of a select through an unbuffered server-side cursor, returns an async generator. '
+    return _iter_select(_driver.prepare(sql), args, batch_size)
+
+async def _iter_select(sql, args, batch_size=1000, cursor='stream_dict'):
+    # inside transaction() this streams on the pinned connection, do not run other queries until exhausted.
+    log(sql, args)
+    start = time.perf_counter()
+    rows = 0
+    async with _reader() as conn:
+        acquired = time.perf_counter()
+        async with conn.cursor(_driver.cursors[cursor]) as cur:
+            await cur.execute(sql, args or ())
+            while True:
+                rs = await cur.fetchmany(batch_size)
+                if not rs:
+                    break
+                rows += len(rs)
+                for r in rs:
+                    yield r
+        _stats.record(sql, time.perf_counter() - acquired, rows, acquired - start)
+
 async def execute(sql, args, autocommit=True):
+    return await _execute(_driver.prepare(sql), args, autocommit)
+
+async def _execute(sql, args, autocommit=True):
+    ' execute with driver-ready sql (placeholders already converted). '
     log(sql)
-    async with __pool.get() as conn:
+    if _transaction.get() is not None:
+        autocommit = True # 由外层事务提交
+    start = time.perf_counter()
+    async with _writer() as conn:
+        acquired = time.perf_counter()
         if not autocommit:
             await conn.begin()
         try:
-            async with conn.cursor(aiomysql.DictCursor) as cur:
-                await cur.execute(sql.replace('?', '%s'), args)
+            async with conn.cursor(_driver.cursors['dict']) as cur:
+                await cur.execute(sql, args)
                 affected = cur.rowcount
             if not autocommit:
                 await conn.commit()
@@ -62,8 +516,589 @@ async def execute(sql, args, autocommit=True):
             if not autocommit:
                 await conn.rollback()
             raise
+        finally:
+            _written(sql)
+        _stats.record(sql, time.perf_counter() - acquired, affected, acquired - start)
         return affected
 
+class PlanCache(object):
+    '''
+    LRU cache of driver-ready sql keyed by query shape, e.g. (model, where, orderBy, limit shape).
+    '''
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._plans = collections.OrderedDict()
+
+    def get(self, key, build):
+        sql = self._plans.get(key)
+        if sql is not None:
+            self.hits += 1
+            self._plans.move_to_end(key)
+            return sql
+        self.misses += 1
+        sql = self._plans[key] = _driver.prepare(build())
+        # 批量语句按行数各占一项, 淘汰最久未用的:
+        if len(self._plans) > self.maxsize:
+            self._plans.popitem(last=False)
+            self.evictions += 1
+        return sql
+
+    def clear(self):
+        self._plans.clear()
+
+    def stats(self):
+        return dict(size=len(self._plans), hits=self.hits, misses=self.misses, evictions=self.evictions)
+
+_plans = PlanCache()
+
+_RE_READ = re.compile(r'\b(?:from|join)\s+`?(\w+)`?', re.I)
+_RE_WRITE = re.compile(r'^\s*(?:insert\s+(?:ignore\s+)?into|replace\s+into|update|delete\s+from|truncate(?:\s+table)?|(?:alter|drop)\s+table(?:\s+if\s+exists)?)\s+`?(\w+)`?', re.I)
+
+@functools.lru_cache(maxsize=1024)
+def read_tables(sql):
+    ' tables a select reads. '
+    return frozenset(t.lower() for t in _RE_READ.findall(sql))
+
+@functools.lru_cache(maxsize=1024)
+def write_table(sql):
+    ' table a statement writes, None if unknown (invalidates every cached query). '
+    m = _RE_WRITE.match(sql)
+    return m.group(1).lower() if m else None
+
+class QueryCache(object):
+    '''
+    Result cache of select(..., cache=True) keyed by (sql, args) and tagged with the tables the sql reads.
+    LRU within a memory budget (estimated bytes); entries are fresh for ttl seconds, then served for up to
+    stale more seconds while one background query refreshes them. concurrent misses share one query.
+    '''
+    def __init__(self, budget=16 * 1024 * 1024, ttl=10, stale=30):
+        self.budget = budget
+        self.ttl = ttl
+        self.stale = stale
+        self.bytes = 0
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self._entries = collections.OrderedDict() # key => (rows, tables, bytes, fresh until, stale until)
+        self._tags = collections.defaultdict(set) # table => keys
+        self._generations = collections.defaultdict(int)
+        self._loading = dict()
+        self.hold = 0 # 同RowCache.hold
+        self._invalidated = dict() # table => time, None => time
+
+    async def get(self, key, tables, load):
+        e = self._entries.get(key)
+        if e is not None:
+            now = time.time()
+            if now < e[3]:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return list(e[0])
+            if now < e[4]:
+                self._entries.move_to_end(key)
+                self.stale_hits += 1
+                if key not in self._loading:
+                    # 后台刷新, 不沿用调用者的事务或会话:
+                    asyncio.get_event_loop().call_soon(self._refresh, key, tables, load, context=contextvars.Context())
+                return list(e[0])
+        self.misses += 1
+        fut = self._loading.get(key)
+        if fut is None:
+            fut = self._load(key, tables, load)
+        return list(await asyncio.shield(fut))
+
+    def _refresh(self, key, tables, load):
+        if key not in self._loading:
+            self._load(key, tables, load)
+
+    def _load(self, key, tables, load):
+        generations = [self._generations[t] for t in tables]
+        fut = self._loading[key] = asyncio.ensure_future(load())
+        def done(fut):
+            del self._loading[key]
+            if fut.cancelled() or fut.exception() is not None:
+                return
+            # 查询期间表被写过则不缓存:
+            if generations == [self._generations[t] for t in tables]:
+                self._put(key, tables, fut.result())
+        fut.add_done_callback(done)
+        return fut
+
+    def _put(self, key, tables, rows):
+        if self.hold:
+            now = time.time()
+            if any(now - self._invalidated.get(t, 0) < self.hold for t in (None,) + tuple(tables)):
+                return
+        size = sizeof_rows(rows)
+        if size > self.budget:
+            return
+        self._discard(key)
+        now = time.time()
+        self._entries[key] = (rows, tables, size, now + self.ttl, now + self.ttl + self.stale)
+        self.bytes += size
+        for t in tables:
+            self._tags[t].add(key)
+        while self.bytes > self.budget:
+            self._discard(next(iter(self._entries)))
+            self.evictions += 1
+
+    def _discard(self, key):
+        e = self._entries.pop(key, None)
+        if e is None:
+            return
+        self.bytes -= e[2]
+        for t in e[1]:
+            keys = self._tags.get(t)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._tags[t]
+
+    def invalidate(self, table=None):
+        ' drop entries reading table, or every entry when table is None. '
+        self.invalidations += 1
+        if self.hold:
+            self._invalidated[table] = time.time()
+        if table is None:
+            for t in list(self._generations) + list(self._tags):
+                self._generations[t] += 1
+            self._entries.clear()
+            self._tags.clear()
+            self.bytes = 0
+            return
+        self._generations[table] += 1
+        for key in list(self._tags.get(table, ())):
+            self._discard(key)
+
+    def stats(self):
+        return dict(size=len(self._entries), bytes=self.bytes, budget=self.budget, hits=self.hits, stale_hits=self.stale_hits,
+            misses=self.misses, evictions=self.evictions, invalidations=self.invalidations)
+
+def sizeof_rows(rows):
+    ' rough memory footprint of a result set in bytes. '
+    size = sys.getsizeof(rows)
+    for r in rows:
+        size += sys.getsizeof(r) + sum(map(sys.getsizeof, r.values() if isinstance(r, dict) else r))
+    return size
+
+_query_cache = QueryCache()
+
+def query_cache_stats():
+    ' hit/miss/eviction statistics of the query result cache. '
+    return _query_cache.stats()
+
+def _written(sql):
+    ' invalidate cached selects of the table sql writes, again after commit inside transaction(). '
+    table = write_table(sql)
+    _query_cache.invalidate(table)
+    tx = _transaction.get()
+    if tx is not None:
+        tx.after_commit(functools.partial(_query_cache.invalidate, table))
+
+# 默认mysql, create_pool按configs.db的driver切换
+_driver = get_driver('mysql')
+
+def plan_stats():
+    ' hit/miss counters of the query plan cache. '
+    return _plans.stats()
+
+def build_select(select, where=None, orderBy=None, limit=None):
+    ' build select sql, limit is the limit shape: None, 1 (limit ?) or 2 (limit ?, ?). '
+    sql = [select]
+    if where:
+        sql.append('where')
+        sql.append(where)
+    if orderBy:
+        sql.append('order by')
+        sql.append(orderBy)
+    if limit == 1:
+        sql.append('limit ?')
+    elif limit == 2:
+        sql.append('limit ?, ?')
+    return ' '.join(sql)
+
+def _order_key(orderBy):
+    ' order by clause without backticks, spacing and case, for comparison. '
+    return ','.join(' '.join(s.split()) for s in orderBy.replace('`', '').lower().split(','))
+
+class IdentityMap(object):
+    '''
+    Request-scoped map of loaded instances keyed by (model, primary key).
+    '''
+    def __init__(self):
+        self._objs = dict()
+
+    def get(self, cls, pk):
+        return self._objs.get((cls, pk))
+
+    def add(self, obj):
+        self._objs[(obj.__class__, obj.getValue(obj.__primary_key__))] = obj
+
+    def discard(self, cls, pk):
+        self._objs.pop((cls, pk), None)
+
+    def discardModel(self, cls):
+        for key in [k for k in self._objs if k[0] is cls]:
+            del self._objs[key]
+
+class RowCache(object):
+    '''
+    Process-wide LRU cache of rows by primary key, entries expire after ttl seconds.
+    '''
+    def __init__(self, size=1000, ttl=60):
+        self.size = size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # bumped on every invalidation so that reads started before a write are not cached:
+        self.generation = 0
+        # 失效后hold秒内不缓存读到的行, 从库可能还没有同步这次写入:
+        self.hold = 0
+        self._invalidated = collections.OrderedDict()
+        self._cleared_at = 0
+        self._rows = collections.OrderedDict()
+
+    def get(self, pk):
+        e = self._rows.get(pk)
+        if e is None:
+            self.misses += 1
+            return None
+        row, expires = e
+        if expires < time.time():
+            del self._rows[pk]
+            self.misses += 1
+            return None
+        self._rows.move_to_end(pk)
+        self.hits += 1
+        return row
+
+    def put(self, pk, row, generation):
+        if generation != self.generation:
+            return
+        if self.hold:
+            now = time.time()
+            if now - max(self._invalidated.get(pk, 0), self._cleared_at) < self.hold:
+                return
+        self._rows[pk] = (row, time.time() + self.ttl)
+        self._rows.move_to_end(pk)
+        while len(self._rows) > self.size:
+            self._rows.popitem(last=False)
+            self.evictions += 1
+
+    def invalidate(self, pk):
+        self.generation += 1
+        self._rows.pop(pk, None)
+        if self.hold:
+            now = time.time()
+            self._invalidated[pk] = now
+            self._invalidated.move_to_end(pk)
+            while self._invalidated and (len(self._invalidated) > self.size or now - next(iter(self._invalidated.values())) >= self.hold):
+                self._invalidated.popitem(last=False)
+
+    def clear(self):
+        self.generation += 1
+        self._rows.clear()
+        self._invalidated.clear()
+        self._cleared_at = time.time()
+
+    def stats(self):
+        return dict(size=len(self._rows), hits=self.hits, misses=self.misses, evictions=self.evictions)
+
+class FindBatcher(object):
+    '''
+    Collects Model.find(pk) calls made in the same event loop tick and loads them with one in (...) query.
+    '''
+    def __init__(self, cls, max_batch=500):
+        self.cls = cls
+        self.max_batch = max_batch
+        self.batches = 0
+        self.loads = 0
+        self._pending = dict()
+
+    async def load(self, pk):
+        ' row tuple for pk, or None if not found. '
+        self.loads += 1
+        fut = self._pending.get(pk)
+        if fut is None:
+            loop = asyncio.get_event_loop()
+            if not self._pending:
+                # 在空的上下文中查询, 不沿用第一个调用者的事务或会话:
+                loop.call_soon(self._dispatch, context=contextvars.Context())
+            fut = self._pending[pk] = loop.create_future()
+        return await asyncio.shield(fut)
+
+    def _dispatch(self):
+        pending, self._pending = self._pending, dict()
+        asyncio.ensure_future(self._fetch(pending))
+
+    async def _fetch(self, pending):
+        cls = self.cls
+        pks = list(pending)
+        rows = dict()
+        try:
+            for i in range(0, len(pks), self.max_batch):
+                chunk = pks[i:i + self.max_batch]
+                n = len(chunk)
+                sql = _plans.get((cls, 'find_many', n), lambda: '%s where `%s` in (%s)' % (cls.__select__, cls.__primary_key__, create_args_string(n)))
+                for r in await _select(sql, chunk, None, 'tuple'):
+                    rows[r[0]] = r
+                self.batches += 1
+        except Exception as e:
+            for fut in pending.values():
+                if not fut.done():
+                    fut.set_exception(e)
+            return
+        except BaseException as e:
+            for fut in pending.values():
+                fut.cancel()
+            raise
+        for pk, fut in pending.items():
+            if not fut.done():
+                fut.set_result(rows.get(pk))
+
+    def stats(self):
+        return dict(loads=self.loads, batches=self.batches)
+
+class RowCounter(object):
+    '''
+    In-memory row count of a table, adjusted on inserts and deletes made by this process
+    and reconciled with select count(...) every `reconcile` seconds.
+    '''
+    def __init__(self, reconcile=60):
+        self.reconcile = reconcile
+        self.count = None
+        self.hits = 0
+        self.reconciles = 0
+        self._checked_at = 0
+        self._loading = None
+
+    async def get(self, load):
+        if self.count is not None and time.time() - self._checked_at < self.reconcile:
+            self.hits += 1
+            return self.count
+        if self._loading is None:
+            self._loading = asyncio.ensure_future(load())
+            try:
+                count = await asyncio.shield(self._loading)
+            finally:
+                self._loading = None
+            self.count = count
+            self._checked_at = time.time()
+            self.reconciles += 1
+            return count
+        return await asyncio.shield(self._loading)
+
+    def adjust(self, delta):
+        if self.count is not None:
+            self.count += delta
+
+    def reset(self):
+        ' reload on the next get(). '
+        self.count = None
+
+    def stats(self):
+        return dict(count=self.count, hits=self.hits, reconciles=self.reconciles)
+
+class WriteBehind(object):
+    '''
+    Write-behind insert queue of a model: save_later() returns once an instance is queued, a background task
+    inserts queued instances with save_many() every batch_size instances or interval seconds.
+    The queue holds at most maxsize instances (save_later() waits for room), batches that fail and instances
+    still queued at close() are appended to the spill file as json lines and inserted again by start().
+    '''
+    def __init__(self, cls, batch_size=100, interval=0.05, maxsize=10000, spill=None):
+        self.cls = cls
+        self.batch_size = batch_size
+        self.interval = interval
+        self.maxsize = maxsize
+        self.spill = spill
+        self.queued = 0
+        self.inserted = 0
+        self.batches = 0
+        self.failures = 0
+        self.spilled = 0
+        self._queue = None
+        self._task = None
+        self._batch = []
+
+    @property
+    def running(self):
+        return self._task is not None
+
+    async def start(self):
+        if self._task is not None:
+            return
+        await self._replay()
+        self._queue = asyncio.Queue(self.maxsize)
+        self._task = asyncio.ensure_future(self._run())
+
+    async def put(self, obj):
+        ' queue obj, waits while the queue is full. '
+        self.queued += 1
+        await self._queue.put(obj)
+
+    async def _run(self):
+        q = self._queue
+        loop = asyncio.get_event_loop()
+        closing = False
+        while not closing:
+            obj = await q.get()
+            if obj is None:
+                break
+            batch = self._batch = [obj]
+            deadline = loop.time() + self.interval
+            while len(batch) < self.batch_size:
+                try:
+                    obj = q.get_nowait() if not q.empty() else await asyncio.wait_for(q.get(), deadline - loop.time())
+                except asyncio.TimeoutError:
+                    break
+                if obj is None:
+                    closing = True
+                    break
+                batch.append(obj)
+            await self._flush(batch)
+            self._batch = []
+
+    async def _flush(self, batch, on_conflict=None):
+        try:
+            inserted = await self.cls.save_many(batch, on_conflict=on_conflict)
+        except Exception as e:
+            self.failures += 1
+            logging.exception('write-behind insert of %s %s failed' % (len(batch), self.cls.__table__))
+            self._spill(batch)
+            return
+        self.batches += 1
+        self.inserted += inserted
+
+    def _spill(self, objs):
+        if not objs:
+            return
+        if self.spill is None:
+            logging.error('dropped %s queued %s: no spill file' % (len(objs), self.cls.__table__))
+            return
+        # 追加写入并fsync, 下次start()时重新插入:
+        with open(self.spill, 'a', encoding='utf-8') as f:
+            for obj in objs:
+                f.write(json.dumps(dict((k, obj.get(k)) for k in self.cls.__mappings__), ensure_ascii=False))
+                f.write('\n')
+            f.flush()
+            os.fsync(f.fileno())
+        self.spilled += len(objs)
+        logging.warning('spilled %s queued %s to %s' % (len(objs), self.cls.__table__, self.spill))
+
+    async def _replay(self):
+        if self.spill is None:
+            return
+        path = '%s.replay' % self.spill
+        if os.path.exists(self.spill):
+            # 追加到上次中断的replay文件之后, 不覆盖:
+            with open(self.spill, encoding='utf-8') as src, open(path, 'a', encoding='utf-8') as dst:
+                dst.write(src.read())
+                dst.flush()
+                os.fsync(dst.fileno())
+            os.remove(self.spill)
+        if not os.path.exists(path):
+            return
+        with open(path, encoding='utf-8') as f:
+            objs = [self.cls(**json.loads(line)) for line in f if line.strip()]
+        logging.info('replay %s spilled %s from %s' % (len(objs), self.cls.__table__, path))
+        # 溢出的批次可能已经提交(如close()超时取消时), 或上次replay中断前已插入, 跳过已存在的主键:
+        for i in range(0, len(objs), self.batch_size):
+            await self._flush(objs[i:i + self.batch_size], 'ignore')
+        os.remove(path)
+
+    async def close(self, timeout=10):
+        ' insert queued instances, spilling whatever is not inserted within timeout seconds. '
+        if self._task is None:
+            return
+        task, self._task = self._task, None
+        q = self._queue
+        try:
+            await asyncio.wait_for(q.put(None), timeout)
+            await asyncio.wait_for(asyncio.shield(task), timeout)
+        except asyncio.TimeoutError:
+            task.cancel()
+            self._spill(self._batch)
+        left = []
+        while not q.empty():
+            obj = q.get_nowait()
+            if obj is not None:
+                left.append(obj)
+        self._spill(left)
+
+    def stats(self):
+        return dict(running=self.running, depth=self._queue.qsize() if self._queue else 0, queued=self.queued,
+            inserted=self.inserted, batches=self.batches, failures=self.failures, spilled=self.spilled)
+
+_models = []
+
+def cache_stats():
+    ' hit/miss/eviction statistics of every model configured with __cache__. '
+    return dict((m.__table__, m.__rowcache__.stats()) for m in _models if m.__rowcache__ is not None)
+
+def counter_stats():
+    ' cached row counts of every model configured with __counter__. '
+    return dict((m.__table__, m.__rowcounter__.stats()) for m in _models if m.__rowcounter__ is not None)
+
+def writer_stats():
+    ' queue depth and inserted/spilled counts of every model configured with __write_behind__. '
+    return dict((m.__table__, m.__writer__.stats()) for m in _models if m.__writer__ is not None)
+
+def batch_stats():
+    ' find() calls and batched queries of every model configured with __batch__. '
+    return dict((m.__table__, m.__batcher__.stats()) for m in _models if m.__batcher__ is not None)
+
+_identity_map = contextvars.ContextVar('identity_map', default=None)
+
+@contextlib.contextmanager
+def identity_map():
+    ' opt-in unit of work: Model.find(pk) returns already-loaded instances inside this scope. '
+    m = IdentityMap()
+    token = _identity_map.set(m)
+    try:
+        yield m
+    finally:
+        _identity_map.reset(token)
+
+async def _execute_all(stmts):
+    ' execute (sql, args) pairs with driver-ready sql on one connection inside a single transaction. '
+    affected = 0
+    async with transaction() as tx:
+        async with tx.conn.cursor(_driver.cursors['dict']) as cur:
+            written = set()
+            try:
+                for sql, args in stmts:
+                    log(sql)
+                    written.add(sql)
+                    start = time.perf_counter()
+                    await cur.execute(sql, args)
+                    affected += cur.rowcount
+                    _stats.record(sql, time.perf_counter() - start, cur.rowcount, 0.0)
+            finally:
+                for sql in written:
+                    _written(sql)
+    return affected
+
+def select_columns(cls, names):
+    ' select sql for the primary key plus the given field names. '
+    return 'select `%s`, %s from `%s`' % (cls.__primary_key__, ', '.join(map(lambda f: '`%s`' % f, names)), cls.__table__)
+
+def upsert_clause(cls, on_conflict, fields):
+    ' suffix for __insert__ handling duplicate keys: on_conflict is \'update\' (fields) or \'ignore\'. '
+    if on_conflict == 'update':
+        for f in fields:
+            if f not in cls.__fields__:
+                raise ValueError('Invalid update field: %s' % f)
+    elif on_conflict != 'ignore':
+        raise ValueError('Invalid on_conflict value: %s' % on_conflict)
+    return _driver.upsert_clause(cls, on_conflict, fields)
+
 def create_args_string(num):
     L = []
     for n in range(num):
@@ -72,6 +1107,8 @@ def create_args_string(num):
 
 class Field(object):
 
+    convert = None # 把驱动返回的值转换为python类型, None表示不转换
+
     def __init__(self, name, column_type, primary_key, default):
         self.name = name
         self.column_type = column_type
@@ -88,16 +1125,22 @@ class StringField(Field):
 
 class BooleanField(Field):
 
+    convert = bool
+
     def __init__(self, name=None, default=False):
         super().__init__(name, 'boolean', False, default)
 
 class IntegerField(Field):
 
+    convert = int
+
     def __init__(self, name=None, primary_key=False, default=0):
         super().__init__(name, 'bigint', primary_key, default)
 
 class FloatField(Field):
 
+    convert = float
+
     def __init__(self, name=None, primary_key=False, default=0.0):
         super().__init__(name, 'real', primary_key, default)
 
@@ -106,8 +1149,159 @@ class TextField(Field):
     def __init__(self, name=None, default=None):
         super().__init__(name, 'text', False, default)
 
+class ModelRow(collections.abc.Mapping):
+    '''
+    Compact row with real __slots__ per field, generated by ModelMetaclass as Model.__row__.
+    Supports attribute access and the read-only dict (Mapping) interface.
+    '''
+    __slots__ = ()
+
+    def __init__(self, **kw):
+        for k, v in kw.items():
+            setattr(self, k, v)
+
+    def __getitem__(self, key):
+        try:
+            return getattr(self, key)
+        except AttributeError:
+            raise KeyError(key)
+
+    def __iter__(self):
+        for k in self.__slots__:
+            if hasattr(self, k):
+                yield k
+
+    def __len__(self):
+        return sum(1 for k in self)
+
+    def __repr__(self):
+        return '%s(%s)' % (self.__class__.__name__, ', '.join('%s=%r' % (k, self[k]) for k in self))
+
+def make_builder(target, columns, compact=False, converters=None):
+    ' generate a function building a target instance from a row tuple in columns order, converting values by converters[column]. '
+    ns = dict(new=object.__new__ if compact else dict.__new__, target=target)
+    targets = []
+    values = []
+    for i, c in enumerate(columns):
+        targets.append('o.%s' % c if compact else 'o[%r]' % c)
+        convert = converters.get(c) if converters else None
+        if convert is None:
+            values.append('v%d' % i)
+        else:
+            # 非空值才转换:
+            ns['c%d' % i] = convert
+            values.append('None if v%d is None else c%d(v%d)' % (i, i, i))
+    src = 'def build(row):\n    o = new(target)\n    %s, = row\n    %s, = %s,\n    return o\n' % (', '.join('v%d' % i for i in range(len(columns))), ', '.join(targets), ', '.join('(%s)' % v for v in values))
+    exec(src, ns)
+    return ns['build']
+
+def make_to_args(mappings, columns):
+    ' generate a function returning the args of columns from an instance, storing defaults for missing or None values. '
+    ns = dict()
+    lines = []
+    for i, c in enumerate(columns):
+        default = mappings[c].default
+        lines.append('    v%d = get(%r)\n' % (i, c))
+        if default is not None:
+            ns['d%d' % i] = default
+            lines.append('    if v%d is None:\n        v%d = o[%r] = d%d%s\n' % (i, i, c, i, '()' if callable(default) else ''))
+    src = 'def to_args(o):\n    get = o.get\n%s    return [%s]\n' % (''.join(lines), ', '.join('v%d' % i for i in range(len(columns))))
+    exec(src, ns)
+    return ns['to_args']
+
+class Index(object):
+    '''
+    Index declaration for Model.__indexes__, e.g. Index('blog_id', 'created_at') or Index('email', unique=True).
+    '''
+    def __init__(self, *columns, unique=False, name=None):
+        self.columns = columns
+        self.unique = unique
+        self.name = name or '%s_%s' % ('uniq' if unique else 'idx', '_'.join(columns))
+
+    def __str__(self):
+        return '<%s%s: %s>' % ('Unique' if self.unique else '', self.__class__.__name__, ', '.join(self.columns))
+
+class Relation(object):
+    '''
+    Base of declared relations, loaded for a whole result set by Model.prefetch() or findAll(prefetch=[...]).
+    A loaded relation is stored in the instance dict under its name.
+    '''
+    chunk_size = 500 # 每条in查询最多的键数
+
+    def __init__(self, target, key, orderBy=None):
+        self.target = target
+        self.key = key
+        self.orderBy = orderBy
+        self.name = None
+
+    def __set_name__(self, owner, name):
+        self.name = name
+        owner.__relations__[name] = self
+
+    def __get__(self, obj, cls=None):
+        if obj is None:
+            return self
+        try:
+            return obj[self.name]
+        except KeyError:
+            raise AttributeError(r"relation '%s' is not loaded, await prefetch() first" % self.name)
+
+    async def _findIn(self, column, keys, cache):
+        ' target objects whose column is in keys, one query per chunk_size keys. '
+        rs = []
+        for i in range(0, len(keys), self.chunk_size):
+            chunk = keys[i:i + self.chunk_size]
+            rs.extend(await self.target.findAll('`%s` in (%s)' % (column, create_args_string(len(chunk))), chunk, orderBy=self.orderBy, cache=cache))
+        return rs
+
+class HasMany(Relation):
+    '''
+    One-to-many relation: Blog.comments = HasMany(Comment, 'blog_id', orderBy='created_at desc')
+    loads a list of targets whose key column holds the owner's primary key.
+    '''
+    def __init__(self, target, key, orderBy=None):
+        if key not in target.__mappings__:
+            raise ValueError('Relation field not found: %s' % key)
+        super().__init__(target, key, orderBy)
+
+    async def find(self, pk, cache=False):
+        ' targets of the owner with primary key pk, without loading the owner, e.g. next to it in a pipeline. '
+        return await self.target.findAll('`%s`=?' % self.key, [pk], orderBy=self.orderBy, cache=cache)
+
+    async def prefetch(self, objs, cache=False):
+        pks = list(dict.fromkeys(o.getValue(o.__primary_key__) for o in objs))
+        groups = collections.defaultdict(list)
+        for t in await self._findIn(self.key, pks, cache):
+            groups[t[self.key]].append(t)
+        for o in objs:
+            dict.__setitem__(o, self.name, groups.get(o.getValue(o.__primary_key__), []))
+        return [t for ts in groups.values() for t in ts]
+
+class BelongsTo(Relation):
+    '''
+    Many-to-one relation: Comment.user = BelongsTo(User, 'user_id') loads the target
+    whose primary key is the owner's key column, or None.
+    '''
+    def __set_name__(self, owner, name):
+        if self.key not in owner.__mappings__:
+            raise ValueError('Relation field not found: %s' % self.key)
+        super().__set_name__(owner, name)
+
+    async def prefetch(self, objs, cache=False):
+        keys = list(dict.fromkeys(k for k in (o.getValue(self.key) for o in objs) if k is not None))
+        targets = dict((t.getValue(t.__primary_key__), t) for t in await self._findIn(self.target.__primary_key__, keys, cache))
+        for o in objs:
+            dict.__setitem__(o, self.name, targets.get(o.getValue(self.key)))
+        return list(targets.values())
+
 class ModelMetaclass(type):
 
+    def __setattr__(cls, name, value):
+        # 类定义之后声明的关系, 如 Blog.comments = HasMany(Comment, 'blog_id'):
+        if isinstance(value, Relation):
+            value.__set_name__(cls, name)
+        type.__setattr__(cls, name, value)
+
     def __new__(cls, name, bases, attrs):
         if name=='Model':
             return type.__new__(cls, name, bases, attrs)
@@ -129,6 +1323,15 @@ class ModelMetaclass(type):
                     fields.append(k)
         if not primaryKey:
             raise StandardError('Primary key not found.')
+        deferred = tuple(attrs.get('__deferred__', ()))
+        for k in deferred:
+            if k not in fields:
+                raise ValueError('Deferred field not found: %s' % k)
+        indexes = tuple(attrs.get('__indexes__', ()))
+        for index in indexes:
+            for k in index.columns:
+                if k not in mappings:
+                    raise ValueError('Index field not found: %s' % k)
         for k in mappings.keys():
             attrs.pop(k)
         escaped_fields = list(map(lambda f: '`%s`' % f, fields))
@@ -136,26 +1339,78 @@ class ModelMetaclass(type):
         attrs['__table__'] = tableName
         attrs['__primary_key__'] = primaryKey # 主键属性名
         attrs['__fields__'] = fields # 除主键外的属性名
+        attrs['__deferred__'] = deferred # findAll默认不加载的大字段
+        attrs['__eager__'] = tuple(f for f in fields if f not in deferred)
+        attrs['__indexes__'] = indexes
+        attrs['__relations__'] = dict() # 名称 => Relation
+        attrs['__converters__'] = dict((k, v.convert) for k, v in mappings.items() if v.convert is not None)
         attrs['__select__'] = 'select `%s`, %s from `%s`' % (primaryKey, ', '.join(escaped_fields), tableName)
         attrs['__insert__'] = 'insert into `%s` (%s, `%s`) values (%s)' % (tableName, ', '.join(escaped_fields), primaryKey, create_args_string(len(escaped_fields) + 1))
         attrs['__update__'] = 'update `%s` set %s where `%s`=?' % (tableName, ', '.join(map(lambda f: '`%s`=?' % (mappings.get(f).name or f), fields)), primaryKey)
         attrs['__delete__'] = 'delete from `%s` where `%s`=?' % (tableName, primaryKey)
-        return type.__new__(cls, name, bases, attrs)
+        cache = attrs.get('__cache__', None)
+        attrs['__rowcache__'] = RowCache(**cache) if cache else None # 主键读缓存
+        counter = attrs.get('__counter__', None)
+        attrs['__rowcounter__'] = RowCounter(**counter) if counter else None # 行数缓存
+        model = type.__new__(cls, name, bases, attrs)
+        # 同一tick内的find合并为一次in查询:
+        batch = attrs.get('__batch__', None)
+        model.__batcher__ = FindBatcher(model, **(batch if isinstance(batch, dict) else dict())) if batch else None
+        # 延迟批量插入:
+        write_behind = attrs.get('__write_behind__', None)
+        model.__writer__ = WriteBehind(model, **(write_behind if isinstance(write_behind, dict) else dict())) if write_behind else None
+        # 紧凑表示: 每个字段一个slot
+        model.__row__ = type('%sRow' % name, (ModelRow,), dict(__slots__=tuple([primaryKey] + fields), __model__=model))
+        # 按__select__列顺序从元组构造实例, 跳过DictCursor的中间dict:
+        model.__builders__ = dict()
+        model.__build__ = model._builder(tuple([primaryKey] + fields))
+        # 按__insert__列顺序取参数并填充默认值:
+        model.__to_args__ = make_to_args(mappings, tuple(fields + [primaryKey]))
+        _models.append(model)
+        return model
 
 class Model(dict, metaclass=ModelMetaclass):
 
+    __seek__ = 'created_at' # 键集分页(keyset)使用的排序列
+    __deferred__ = ()
+    __relations__ = dict()
+    # 自加载以来修改过的属性名: ()表示从数据库加载且未修改, None表示新建的对象(不跟踪)
+    _changed = ()
+
     def __init__(self, **kw):
         super(Model, self).__init__(**kw)
+        self.__dict__['_changed'] = None
 
     def __getattr__(self, key):
         try:
             return self[key]
         except KeyError:
+            if key in self.__deferred__:
+                raise AttributeError(r"deferred column '%s' is not loaded, await load() first" % key)
+            if key in self.__relations__:
+                raise AttributeError(r"relation '%s' is not loaded, await prefetch() first" % key)
             raise AttributeError(r"'Model' object has no attribute '%s'" % key)
 
     def __setattr__(self, key, value):
+        changed = self._changed
+        if changed is not None and (key not in self or self[key] != value):
+            if not changed:
+                changed = self.__dict__['_changed'] = set()
+            changed.add(key)
         self[key] = value
 
+    def copy(self):
+        ' shallow copy of the same model with the same modified attributes. '
+        obj = dict.__new__(self.__class__)
+        dict.update(obj, self)
+        changed = self._changed
+        obj.__dict__['_changed'] = set(changed) if changed else changed
+        return obj
+
+    def _clean(self):
+        ' mark as loaded and unmodified. '
+        self.__dict__.pop('_changed', None)
+
     def getValue(self, key):
         return getattr(self, key, None)
 
@@ -171,67 +1426,422 @@ class Model(dict, metaclass=ModelMetaclass):
 
     @classmethod
     async def findAll(cls, where=None, args=None, **kw):
-        ' find objects by where clause. '
-        sql = [cls.__select__]
-        if where:
-            sql.append('where')
-            sql.append(where)
-        if args is None:
-            args = []
+        ''' find objects by where clause.
+        after=(seek value, primary key) seeks past that row in `__seek__` desc, primary key desc order.
+        fields=[...] selects only those columns besides the primary key, otherwise `__deferred__` columns are skipped.
+        compact=True returns slot-based `__row__` instances instead of models.
+        cache=True serves the rows from the query cache until the table is written.
+        prefetch=['comments', 'comments.user'] loads declared relations with one in (...) query each. '''
+        prefetch = kw.get('prefetch', None)
+        if prefetch and kw.get('compact', False):
+            raise ValueError('prefetch requires model instances, not compact rows')
+        sql, args, columns = cls._findAllSql(where, args, kw)
+        rs = await _select(sql, args, cursor='tuple', cache=kw.get('cache', False))
+        build = cls._builder(columns, kw.get('compact', False))
+        objs = [build(r) for r in rs]
+        if prefetch:
+            await cls.prefetch(objs, *prefetch, cache=kw.get('cache', False))
+        return objs
+
+    @classmethod
+    async def prefetch(cls, objs, *names, cache=False):
+        ' load relations of objs by name, a dotted name such as \'comments.user\' loads a relation of the loaded targets. '
+        paths = collections.OrderedDict()
+        for name in names:
+            head, _, rest = name.partition('.')
+            if head not in cls.__relations__:
+                raise ValueError('Invalid relation: %s' % head)
+            paths.setdefault(head, [])
+            if rest:
+                paths[head].append(rest)
+        if not objs:
+            return objs
+        for head, rests in paths.items():
+            relation = cls.__relations__[head]
+            targets = await relation.prefetch(objs, cache)
+            if rests and targets:
+                await relation.target.prefetch(targets, *rests, cache=cache)
+        return objs
+
+    @classmethod
+    async def iter(cls, where=None, args=None, batch_size=1000, **kw):
+        ' async generator over objects by where clause, streamed batch_size rows at a time. takes the same keywords as findAll. '
+        sql, args, columns = cls._findAllSql(where, args, kw)
+        build = cls._builder(columns, kw.get('compact', False))
+        async for r in _iter_select(sql, args, batch_size, 'stream_tuple'):
+            yield build(r)
+
+    @classmethod
+    def _builder(cls, columns, compact=False):
+        ' cached row tuple constructor for the given column order. '
+        key = (columns, compact)
+        build = cls.__builders__.get(key)
+        if build is None:
+            build = cls.__builders__[key] = make_builder(cls.__row__ if compact else cls, columns, compact, cls.__converters__)
+        return build
+
+    @classmethod
+    def _findAllSql(cls, where, args, kw):
+        ' returns (driver-ready sql, args, selected columns). '
+        args = list(args) if args else []
+        fields = kw.get('fields', None)
+        if fields is not None:
+            fields = tuple(fields)
+            for f in fields:
+                if f not in cls.__fields__:
+                    raise ValueError('Invalid field: %s' % f)
         orderBy = kw.get('orderBy', None)
-        if orderBy:
-            sql.append('order by')
-            sql.append(orderBy)
         limit = kw.get('limit', None)
+        after = kw.get('after', None)
+        if after is not None:
+            seek, pk = after
+            args.extend((seek, seek, pk))
+            order = '`%s` desc, `%s` desc' % (cls.__seek__, cls.__primary_key__)
+            if orderBy is None:
+                orderBy = order
+            elif _order_key(orderBy) != _order_key(order):
+                # 键集条件只对(seek, pk)倒序成立:
+                raise ValueError('after requires orderBy %s, got: %s' % (order, orderBy))
+        shape = None
         if limit is not None:
-            sql.append('limit')
             if isinstance(limit, int):
-                sql.append('?')
+                shape = 1
                 args.append(limit)
             elif isinstance(limit, tuple) and len(limit) == 2:
-                sql.append('?, ?')
+                shape = 2
                 args.extend(limit)
             else:
                 raise ValueError('Invalid limit value: %s' % str(limit))
-        rs = await select(' '.join(sql), args)
-        return [cls(**r) for r in rs]
+        def build():
+            w = where
+            if after is not None:
+                w = '(`%s` < ? or (`%s` = ? and `%s` < ?))' % (cls.__seek__, cls.__seek__, cls.__primary_key__)
+                if where:
+                    w = '(%s) and %s' % (where, w)
+            if fields is not None or cls.__deferred__:
+                select = select_columns(cls, columns[1:])
+            else:
+                select = cls.__select__
+            return build_select(select, w, orderBy, shape)
+        columns = (cls.__primary_key__,) + (cls.__eager__ if fields is None else fields)
+        return _plans.get((cls, 'findAll', where, orderBy, shape, after is not None, fields), build), args, columns
 
     @classmethod
-    async def findNumber(cls, selectField, where=None, args=None):
+    async def findNumber(cls, selectField, where=None, args=None, cache=False):
         ' find number by select and where. '
-        sql = ['select %s _num_ from `%s`' % (selectField, cls.__table__)]
-        if where:
-            sql.append('where')
-            sql.append(where)
-        rs = await select(' '.join(sql), args, 1)
+        sql = _plans.get((cls, 'findNumber', selectField, where), lambda: build_select('select %s _num_ from `%s`' % (selectField, cls.__table__), where))
+        rs = await _select(sql, args, 1, 'tuple', cache)
         if len(rs) == 0:
             return None
-        return rs[0]['_num_']
+        return rs[0][0]
+
+    @classmethod
+    async def count(cls):
+        ' number of rows, from the in-memory counter when the model declares __counter__. '
+        load = lambda: cls.findNumber('count(`%s`)' % cls.__primary_key__)
+        # 事务内的计数可能包含未提交的行, 不写入共享的计数器:
+        if cls.__rowcounter__ is None or _transaction.get() is not None:
+            return await load()
+        return await cls.__rowcounter__.get(load)
 
     @classmethod
     async def find(cls, pk):
         ' find object by primary key. '
-        rs = await select('%s where `%s`=?' % (cls.__select__, cls.__primary_key__), [pk], 1)
-        if len(rs) == 0:
-            return None
-        return cls(**rs[0])
+        m = _identity_map.get()
+        if m is not None:
+            obj = m.get(cls, pk)
+            if obj is not None:
+                return obj
+        cache = cls.__rowcache__
+        row = cache.get(pk) if cache is not None else None
+        if row is None:
+            # 事务内读到的可能是未提交的数据, 不写入进程级缓存:
+            if _transaction.get() is not None:
+                cache = None
+            generation = cache.generation if cache is not None else None
+            # pipeline()中与其他查询合并发送, 不经过batcher; batcher在空上下文中查询从库, 刚写过的会话也不经过:
+            if cls.__batcher__ is not None and _transaction.get() is None and _pipeline.get() is None and not _pinned():
+                row = await cls.__batcher__.load(pk)
+            else:
+                sql = _plans.get((cls, 'find'), lambda: '%s where `%s`=?' % (cls.__select__, cls.__primary_key__))
+                rs = await _select(sql, [pk], 1, 'tuple')
+                row = rs[0] if rs else None
+            if row is None:
+                return None
+            if cache is not None:
+                cache.put(pk, row, generation)
+        obj = cls.__build__(row)
+        if m is not None:
+            m.add(obj)
+        return obj
 
-    async def save(self):
-        args = list(map(self.getValueOrDefault, self.__fields__))
-        args.append(self.getValueOrDefault(self.__primary_key__))
-        rows = await execute(self.__insert__, args)
-        if rows != 1:
+    @classmethod
+    async def save_many(cls, instances, chunk_size=500, on_conflict=None):
+        ''' insert instances with multi-row insert statements, one round trip per chunk in one transaction.
+        on_conflict='ignore' skips instances whose key already exists. '''
+        if on_conflict not in (None, 'ignore'):
+            raise ValueError('Invalid on_conflict value: %s' % on_conflict)
+        suffix = upsert_clause(cls, on_conflict, ()) if on_conflict else ''
+        to_args = cls.__to_args__
+        rows = [to_args(inst) for inst in instances]
+        if not rows:
+            return 0
+        values = ', (%s)' % create_args_string(len(cls.__fields__) + 1)
+        def statements():
+            for i in range(0, len(rows), chunk_size):
+                chunk = rows[i:i + chunk_size]
+                args = []
+                for r in chunk:
+                    args.extend(r)
+                n = len(chunk)
+                yield _plans.get((cls, 'insert_many', n, on_conflict), lambda: cls.__insert__ + values * (n - 1) + suffix), args
+        affected = await _execute_all(statements())
+        cls._count(affected)
+        if affected != len(rows) and on_conflict is None:
+            logging.warn('failed to insert records: affected rows: %s of %s' % (affected, len(rows)))
+        return affected
+
+    @classmethod
+    async def remove_many(cls, pks, chunk_size=500):
+        ' delete by primary keys with chunked in (...) statements, returns total affected rows. '
+        pks = list(pks)
+        if not pks:
+            return 0
+        m = _identity_map.get()
+        if m is not None:
+            for pk in pks:
+                m.discard(cls, pk)
+        def statements():
+            for i in range(0, len(pks), chunk_size):
+                chunk = pks[i:i + chunk_size]
+                n = len(chunk)
+                yield _plans.get((cls, 'remove_many', n), lambda: 'delete from `%s` where `%s` in (%s)' % (cls.__table__, cls.__primary_key__, create_args_string(n))), chunk
+        try:
+            affected = await _execute_all(statements())
+        finally:
+            cls._invalidate(pks)
+        cls._count(-affected)
+        return affected
+
+    @classmethod
+    async def update_where(cls, values, where=None, args=None, pks=None, chunk_size=500):
+        ' update columns in values (dict) for rows matching where and/or primary keys in pks, returns total affected rows. '
+        if where is None and pks is None:
+            raise ValueError('update_where requires where or pks.')
+        names = sorted(values.keys())
+        for k in names:
+            if k not in cls.__fields__:
+                raise ValueError('Invalid update field: %s' % k)
+        setArgs = [values[k] for k in names]
+        m = _identity_map.get()
+        if m is not None:
+            if pks is None:
+                m.discardModel(cls)
+            else:
+                for pk in pks:
+                    m.discard(cls, pk)
+        args = list(args) if args else []
+        def build(n):
+            sql = ['update `%s` set %s' % (cls.__table__, ', '.join(map(lambda f: '`%s`=?' % (cls.__mappings__[f].name or f), names))), 'where']
+            if n is not None:
+                sql.append('`%s` in (%s)' % (cls.__primary_key__, create_args_string(n)))
+            if where:
+                if n is not None:
+                    sql.append('and')
+                sql.append('(%s)' % where if n is not None else where)
+            return ' '.join(sql)
+        def statements():
+            if pks is None:
+                yield _plans.get((cls, 'update_where', tuple(names), where, None), lambda: build(None)), setArgs + args
+                return
+            L = list(pks)
+            for i in range(0, len(L), chunk_size):
+                chunk = L[i:i + chunk_size]
+                n = len(chunk)
+                yield _plans.get((cls, 'update_where', tuple(names), where, n), lambda: build(n)), setArgs + chunk + args
+        try:
+            return await _execute_all(statements())
+        finally:
+            cls._invalidate(pks)
+
+    @classmethod
+    def _invalidate(cls, pks=None):
+        ' drop cached rows written by primary keys in pks, or every row of the model when pks is None. '
+        cache = cls.__rowcache__
+        if cache is None:
+            return
+        if pks is None:
+            cache.clear()
+        else:
+            for pk in pks:
+                cache.invalidate(pk)
+        tx = _transaction.get()
+        if tx is not None:
+            # 提交前其他连接仍可能读到并缓存旧值, 提交后再清一次:
+            tx.after_commit(functools.partial(cls._invalidate, pks))
+
+    @classmethod
+    def _count(cls, delta):
+        ' adjust the row counter by delta, once committed when inside a transaction. '
+        counter = cls.__rowcounter__
+        if counter is None or not delta:
+            return
+        tx = _transaction.get()
+        if tx is not None:
+            tx.after_commit(functools.partial(counter.adjust, delta))
+        else:
+            counter.adjust(delta)
+
+    def _track(self):
+        ' keep the current identity map pointing at this instance after a write. '
+        m = _identity_map.get()
+        if m is not None:
+            m.add(self)
+
+    def insertArgs(self):
+        ' args for __insert__, in its column order with defaults applied. '
+        return self.__to_args__()
+
+    async def save(self, on_conflict=None, fields=None):
+        ''' insert, returns affected rows.
+        on_conflict='update' updates fields (default all) of the existing row on a duplicate primary or unique key
+        (affected rows: 1 inserted, 2 updated, 0 unchanged), on_conflict='ignore' leaves it alone (0 if it existed). '''
+        cls = self.__class__
+        args = self.insertArgs()
+        if on_conflict is None:
+            sql = _plans.get((cls, 'insert'), lambda: self.__insert__)
+        else:
+            fields = tuple(fields or self.__fields__)
+            sql = _plans.get((cls, 'upsert', on_conflict, fields), lambda: self.__insert__ + upsert_clause(cls, on_conflict, fields))
+        rows = await _execute(sql, args)
+        # sqlite的upsert插入和更新都返回1, 无法区分:
+        ambiguous = on_conflict == 'update' and rows == 1 and not _driver.upsert_reports_update
+        if on_conflict == 'update' and rows == 2 or ambiguous:
+            # 冲突的可能是其他唯一键, 无法确定被更新行的主键:
+            cls._invalidate(None)
+            m = _identity_map.get()
+            if m is not None:
+                m.discardModel(cls)
+            if ambiguous and cls.__rowcounter__ is not None:
+                cls.__rowcounter__.reset()
+                tx = _transaction.get()
+                if tx is not None:
+                    tx.after_commit(cls.__rowcounter__.reset)
+        else:
+            self._invalidate(args[-1:])
+            if rows == 1:
+                self._clean()
+                self._track()
+        self._count(1 if rows == 1 and not ambiguous else 0)
+        if rows != 1 and on_conflict is None:
             logging.warn('failed to insert record: affected rows: %s' % rows)
+        return rows
+
+    async def save_later(self):
+        ''' queue the insert on the model's write-behind queue (__write_behind__) and return without waiting for it,
+        defaults such as the primary key are applied right away. saves immediately if the queue is not running. '''
+        writer = self.__writer__
+        if writer is None or not writer.running:
+            return await self.save()
+        self.__to_args__()
+        await writer.put(self)
+        return 1
+
+    async def upsert(self, fields=None):
+        ' insert or, on a duplicate key, update fields (default all) of the existing row in one statement. '
+        return await self.save(on_conflict='update', fields=fields)
+
+    async def load(self, *names):
+        ' load deferred or unselected columns, all missing ones if no names given. '
+        names = tuple(names or [f for f in self.__fields__ if f not in self])
+        if not names:
+            return self
+        cls = self.__class__
+        sql = _plans.get((cls, 'load', names), lambda: build_select(select_columns(cls, names), '`%s`=?' % cls.__primary_key__))
+        rs = await _select(sql, [self.getValue(self.__primary_key__)], 1, 'tuple')
+        if len(rs) > 0:
+            converters = self.__converters__
+            for k, v in zip(names, rs[0][1:]):
+                convert = converters.get(k)
+                dict.__setitem__(self, k, v if convert is None or v is None else convert(v))
+        return self
 
     async def update(self):
-        args = list(map(self.getValue, self.__fields__))
-        args.append(self.getValue(self.__primary_key__))
-        rows = await execute(self.__update__, args)
+        ''' update by primary key, returns affected rows. for a loaded instance only the attributes modified since
+        loading are written (no round trip if none), for a new one every column set on it. '''
+        cls = self.__class__
+        changed = self._changed
+        if changed is not None:
+            fields = tuple(f for f in self.__fields__ if f in changed)
+        else:
+            fields = self.__fields__
+            if not all(f in self for f in fields):
+                fields = tuple(f for f in fields if f in self)
+        # 只改了非字段属性(如html_content):
+        if not fields:
+            return 0
+        args = list(map(self.get, fields))
+        args.append(self.get(self.__primary_key__))
+        if fields is self.__fields__ or fields == tuple(self.__fields__):
+            sql = _plans.get((cls, 'update'), lambda: self.__update__)
+        else:
+            sql = _plans.get((cls, 'update', fields), lambda: 'update `%s` set %s where `%s`=?' % (cls.__table__, ', '.join(map(lambda f: '`%s`=?' % (cls.__mappings__[f].name or f), fields)), cls.__primary_key__))
+        try:
+            rows = await _execute(sql, args)
+        finally:
+            self._invalidate(args[-1:])
+        self._clean()
+        self._track()
         if rows != 1:
             logging.warn('failed to update by primary key: affected rows: %s' % rows)
+        return rows
 
     async def remove(self):
         args = [self.getValue(self.__primary_key__)]
-        rows = await execute(self.__delete__, args)
+        m = _identity_map.get()
+        if m is not None:
+            m.discard(self.__class__, args[0])
+        try:
+            rows = await _execute(_plans.get((self.__class__, 'remove'), lambda: self.__delete__), args)
+        finally:
+            self._invalidate(args)
+        self._count(-rows)
         if rows != 1:
-            logging.warn('failed to remove by primary key: affected rows: %s' % rows)
\ No newline at end of file
+            logging.warn('failed to remove by primary key: affected rows: %s' % rows)
+
+def create_table_sql(cls):
+    ' create table statement for a model in the current driver dialect, including its primary key and __indexes__ where supported. '
+    return _driver.create_table_sql(cls)
+
+def create_index_sql(cls, index):
+    return _driver.create_index_sql(cls, index)
+
+async def create_all(models=None):
+    ' create missing tables of models (default every Model subclass). '
+    for m in models or _models:
+        logging.info('create table: %s' % m.__table__)
+        await execute(create_table_sql(m), ())
+    return await sync_indexes(models, create=True)
+
+async def sync_indexes(models=None, create=False):
+    '''
+    compare __indexes__ with the indexes in the database, returns the missing ones as (table, index name, columns),
+    creates them if create is True. an existing index whose leading columns match counts as present,
+    a unique index needs an existing unique index on exactly the same columns.
+    '''
+    missing = []
+    for m in models or _models:
+        existing = await _driver.index_columns(select, m.__table__)
+        for index in m.__indexes__:
+            n = len(index.columns)
+            if index.unique:
+                found = any(unique and tuple(cols) == index.columns for cols, unique in existing.values())
+            else:
+                found = any(tuple(cols[:n]) == index.columns for cols, unique in existing.values())
+            if found:
+                continue
+            logging.warning('missing index on %s: %s' % (m.__table__, index))
+            missing.append((m.__table__, index.name, index.columns))
+            if create:
+                await execute(create_index_sql(m, index), ())
+    return missing
@@ -0,0 +1,772 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+Tests of orm against the embedded sqlite driver, run with: python -m unittest test_orm
+'''
+
+import asyncio, json, os, shutil, tempfile, unittest
+
+import orm
+from apis import Cursor
+from models import User, Blog, Comment
+
+try:
+    import handlers
+except Exception: # aiohttp未安装或asyncio.coroutine已移除
+    handlers = None
+
+def blog(name='old'):
+    return Blog(user_id='u', user_name='a', user_image='i', name=name, summary='s', content='c')
+
+def comment(content='x'):
+    return Comment(blog_id='b', user_id='u', user_name='a', user_image='i', content=content)
+
+class OrmTestCase(unittest.TestCase):
+
+    pool_args = dict()
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.db = os.path.join(self.dir, 'awesome.db')
+        Comment.__writer__.spill = os.path.join(self.dir, 'comments.spill')
+        for m in orm._models:
+            if m.__rowcache__ is not None:
+                m.__rowcache__.clear()
+            if m.__rowcounter__ is not None:
+                m.__rowcounter__.reset()
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.wait(self.open())
+
+    def tearDown(self):
+        self.wait(orm.close_pool())
+        self.loop.close()
+        shutil.rmtree(self.dir)
+
+    def wait(self, coro, timeout=10):
+        return self.loop.run_until_complete(asyncio.wait_for(coro, timeout))
+
+    async def open(self, **kw):
+        args = dict(driver='sqlite', db=self.db, user='', password='')
+        args.update(self.pool_args)
+        args.update(kw)
+        await orm.create_pool(None, **args)
+        await orm.create_all()
+
+class TestPlanCache(OrmTestCase):
+
+    def test_reused(self):
+        async def t():
+            await Blog.findAll('name=?', ['a'])
+            before = orm.plan_stats()
+            await Blog.findAll('name=?', ['b'])
+            after = orm.plan_stats()
+            self.assertEqual((after['hits'] - before['hits'], after['misses'] - before['misses']), (1, 0))
+        self.wait(t())
+
+    def test_lru(self):
+        async def t():
+            maxsize, orm._plans.maxsize = orm._plans.maxsize, 3
+            try:
+                await Blog.findAll('name=?', ['a'])
+                for n in range(1, 6):
+                    await Blog.remove_many(['x'] * n)
+                    await Blog.findAll('name=?', ['a']) # 常用的计划保留
+                s = orm.plan_stats()
+                self.assertEqual((s['size'], s['evictions']), (3, 3))
+                before = s['misses']
+                await Blog.findAll('name=?', ['a'])
+                self.assertEqual(orm.plan_stats()['misses'], before)
+            finally:
+                orm._plans.maxsize = maxsize
+        self.wait(t())
+
+class TestSaveMany(OrmTestCase):
+
+    def test_chunked(self):
+        async def t():
+            cs = [comment('c%d' % i) for i in range(5)]
+            self.assertEqual(await Comment.save_many(cs, chunk_size=2), 5)
+            self.assertEqual(sorted(c.content for c in await Comment.findAll()), ['c0', 'c1', 'c2', 'c3', 'c4'])
+            self.assertEqual(await Comment.count(), 5)
+        self.wait(t())
+
+    def test_ignore_existing(self):
+        async def t():
+            cs = [comment('c%d' % i) for i in range(3)]
+            await Comment.save_many(cs[:2])
+            self.assertEqual(await Comment.save_many(cs, on_conflict='ignore'), 1)
+            self.assertEqual(await Comment.findNumber('count(id)'), 3)
+            with self.assertRaises(ValueError):
+                await Comment.save_many(cs, on_conflict='update')
+        self.wait(t())
+
+    def test_rolled_back_together(self):
+        async def t():
+            cs = [comment('c%d' % i) for i in range(4)]
+            await cs[3].save()
+            with self.assertRaises(Exception):
+                await Comment.save_many(cs, chunk_size=2)
+            self.assertEqual(await Comment.findNumber('count(id)'), 1)
+        self.wait(t())
+
+class TestBulk(OrmTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.bs = [blog('b%d' % i) for i in range(5)]
+        self.wait(Blog.save_many(self.bs))
+        self.ids = [b.id for b in self.bs]
+
+    def test_update_where(self):
+        async def t():
+            await Blog.find(self.ids[0]) # 进入行缓存
+            self.assertEqual(await Blog.update_where(dict(name='x'), pks=self.ids[:3], chunk_size=2), 3)
+            self.assertEqual((await Blog.find(self.ids[0])).name, 'x')
+            self.assertEqual(await Blog.update_where(dict(summary='y'), 'name=?', ['x'], pks=self.ids[2:]), 1)
+            self.assertEqual(await Blog.update_where(dict(summary='z'), 'name<>?', ['x']), 2)
+            self.assertEqual(sorted((b.name, b.summary) for b in await Blog.findAll()),
+                [('b3', 'z'), ('b4', 'z'), ('x', 's'), ('x', 's'), ('x', 'y')])
+            with self.assertRaises(ValueError):
+                await Blog.update_where(dict(name='x'))
+            with self.assertRaises(ValueError):
+                await Blog.update_where(dict(missing='x'), pks=self.ids)
+        self.wait(t())
+
+    def test_remove_many(self):
+        async def t():
+            await Blog.find(self.ids[0])
+            self.assertEqual(await Blog.count(), 5)
+            self.assertEqual(await Blog.remove_many(self.ids[:3] + ['missing'], chunk_size=2), 3)
+            self.assertIsNone(await Blog.find(self.ids[0]))
+            self.assertEqual(await Blog.count(), 2)
+            self.assertEqual(await Blog.remove_many([]), 0)
+        self.wait(t())
+
+class TestIdentityMap(OrmTestCase):
+
+    def test_same_instance(self):
+        async def t():
+            c = comment()
+            await c.save()
+            with orm.identity_map():
+                x = await Comment.find(c.id)
+                self.assertIs(await Comment.find(c.id), x)
+                self.assertIs(await Comment.find(c.id), x)
+            self.assertIsNot(await Comment.find(c.id), await Comment.find(c.id))
+        self.wait(t())
+
+    def test_bulk_writes_discard(self):
+        async def t():
+            cs = [comment('c%d' % i) for i in range(2)]
+            await Comment.save_many(cs)
+            with orm.identity_map():
+                await Comment.find(cs[0].id)
+                await Comment.update_where(dict(content='new'), 'content=?', ['c0'])
+                self.assertEqual((await Comment.find(cs[0].id)).content, 'new')
+                await Comment.remove_many([cs[0].id])
+                self.assertIsNone(await Comment.find(cs[0].id))
+        self.wait(t())
+
+class TestRowCache(OrmTestCase):
+
+    def test_read_through(self):
+        async def t():
+            b = blog()
+            await b.save()
+            before = orm.cache_stats()['blogs']
+            x = await Blog.find(b.id)
+            await Blog.find(b.id)
+            s = orm.cache_stats()['blogs']
+            self.assertEqual((s['hits'] - before['hits'], s['size']), (1, 1))
+            x.name = 'new'
+            await x.update()
+            self.assertEqual(orm.cache_stats()['blogs']['size'], 0)
+            self.assertEqual((await Blog.find(b.id)).name, 'new')
+        self.wait(t())
+
+    def test_lru_and_ttl(self):
+        c = orm.RowCache(size=2, ttl=0.05)
+        for pk in 'abc':
+            c.put(pk, (pk,), c.generation)
+        self.assertEqual((c.get('a'), c.get('c'), c.evictions), (None, ('c',), 1))
+        self.wait(asyncio.sleep(0.06))
+        self.assertIsNone(c.get('c'))
+
+    def test_stale_read_not_cached(self):
+        c = orm.RowCache()
+        generation = c.generation
+        c.invalidate('a') # 读取期间发生了写入
+        c.put('a', ('old',), generation)
+        self.assertIsNone(c.get('a'))
+
+class TestKeyset(OrmTestCase):
+
+    def setUp(self):
+        super().setUp()
+        bs = [blog('b%d' % i) for i in range(5)]
+        for i, b in enumerate(bs):
+            b.created_at = 100.0 + i // 2 # 相同的created_at按id排序
+        self.wait(Blog.save_many(bs))
+
+    def test_pages(self):
+        async def t():
+            names, c = [], None
+            while True:
+                bs = await Blog.findAll(orderBy='created_at desc, id desc', after=c, limit=2)
+                names.extend(b.name for b in bs)
+                c = Cursor.after(bs, 2)
+                if c is None:
+                    break
+            self.assertEqual(names, [b.name for b in await Blog.findAll(orderBy='`created_at` desc, `id` desc')])
+            self.assertEqual(sorted(names), ['b0', 'b1', 'b2', 'b3', 'b4'])
+        self.wait(t())
+
+    def test_other_order_rejected(self):
+        with self.assertRaises(ValueError):
+            self.wait(Blog.findAll(orderBy='created_at asc', after=(100.0, ''), limit=2))
+
+    def test_no_cursor_after_empty_page(self):
+        self.assertIsNone(Cursor.after([], 0))
+        self.assertIsNone(Cursor.after([], 10))
+
+    @unittest.skipIf(handlers is None, 'handlers need aiohttp')
+    def test_page_out_of_range(self):
+        r = self.wait(handlers.api_blogs(page='99'))
+        self.assertEqual((r['blogs'], r['cursor']), ([], None))
+
+class TestProjection(OrmTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.b = blog()
+        self.wait(self.b.save())
+
+    def test_deferred(self):
+        async def t():
+            x = (await Blog.findAll())[0]
+            self.assertNotIn('content', x)
+            with self.assertRaises(AttributeError):
+                x.content
+            await x.load()
+            self.assertEqual(x.content, 'c')
+            self.assertEqual((await Blog.find(self.b.id)).content, 'c')
+        self.wait(t())
+
+    def test_fields(self):
+        async def t():
+            x = (await Blog.findAll(fields=['name']))[0]
+            self.assertEqual(sorted(x.keys()), ['id', 'name'])
+            await x.load('summary', 'created_at')
+            self.assertEqual((x.summary, type(x.created_at)), ('s', float))
+            x.name = 'new'
+            await x.update()
+            y = await Blog.find(self.b.id)
+            self.assertEqual((y.name, y.content), ('new', 'c'))
+            with self.assertRaises(ValueError):
+                await Blog.findAll(fields=['missing'])
+        self.wait(t())
+
+class TestIter(OrmTestCase):
+
+    def test_streams_in_order(self):
+        async def t():
+            cs = [comment('c%d' % i) for i in range(7)]
+            for i, c in enumerate(cs):
+                c.created_at = 100.0 + i
+            await Comment.save_many(cs)
+            got = [c.content async for c in Comment.iter('content<>?', ['c3'], batch_size=2, orderBy='created_at desc')]
+            self.assertEqual(got, ['c6', 'c5', 'c4', 'c2', 'c1', 'c0'])
+            rows = [r async for r in Comment.iter(batch_size=3, compact=True)]
+            self.assertEqual(len(rows), 7)
+            self.assertIsInstance(rows[0], Comment.__row__)
+        self.wait(t())
+
+class TestCompact(OrmTestCase):
+
+    def test_rows(self):
+        async def t():
+            b = blog()
+            await b.save()
+            r = (await Blog.findAll(compact=True))[0]
+            self.assertIsInstance(r, Blog.__row__)
+            self.assertFalse(hasattr(r, '__dict__'))
+            self.assertEqual((r.id, r.name, r['summary']), (b.id, 'old', 's'))
+            self.assertNotIn('content', r) # 延迟加载的列
+            self.assertEqual(dict(r)['user_name'], 'a')
+            with self.assertRaises(KeyError):
+                r['content']
+            with self.assertRaises(AttributeError):
+                r.html_content = '<p>c</p>'
+        self.wait(t())
+
+    def test_converted(self):
+        async def t():
+            await User(name='a', email='e', passwd='p', image='i').save()
+            r = (await User.findAll(compact=True))[0]
+            self.assertIs(r.admin, False)
+            self.assertIsInstance(r.created_at, float)
+        self.wait(t())
+
+class TestTupleRows(OrmTestCase):
+
+    def test_builder(self):
+        build = orm.make_builder(Blog, ('id', 'name', 'summary'))
+        x = build(('1', 'n', 's'))
+        self.assertIsInstance(x, Blog)
+        self.assertEqual(dict(x), dict(id='1', name='n', summary='s'))
+        self.assertEqual(x.name, 'n')
+
+    def test_cached_per_columns(self):
+        columns = ('id', 'name')
+        self.assertIs(Blog._builder(columns), Blog._builder(columns))
+        self.assertIsNot(Blog._builder(columns), Blog._builder(columns, compact=True))
+
+    def test_find_paths(self):
+        async def t():
+            b = blog()
+            await b.save()
+            x, y = await Blog.find(b.id), (await Blog.findAll())[0]
+            self.assertEqual((x.name, x.content, y.name), ('old', 'c', 'old'))
+            self.assertEqual(x._changed, ())
+        self.wait(t())
+
+class TestReplica(OrmTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.b = blog()
+        self.wait(self.b.save())
+        self.wait(orm.close_pool())
+        self.replica = os.path.join(self.dir, 'replica.db')
+        shutil.copy(self.db, self.replica) # 不再同步的从库
+        self.wait(self.open(replicas=dict(r1=dict(db=self.replica)), read_your_writes=0.2))
+
+    async def write(self):
+        with orm.session('client1'):
+            x = await Blog.find(self.b.id)
+            x.name = 'new'
+            await x.update()
+            return (await Blog.find(self.b.id)).name
+
+    def test_read_your_writes(self):
+        self.assertEqual(self.wait(self.write()), 'new')
+
+    def test_stale_replica_not_cached(self):
+        async def t():
+            await self.write()
+            self.assertEqual((await Blog.find(self.b.id)).name, 'old')
+            self.assertEqual(orm.cache_stats()['blogs']['size'], 0)
+        self.wait(t())
+
+class TestTransaction(OrmTestCase):
+
+    def test_commit(self):
+        async def t():
+            b = blog()
+            async with orm.transaction():
+                await b.save()
+                await comment().save()
+            self.assertEqual((await Blog.find(b.id)).name, 'old')
+            self.assertEqual(await Comment.count(), 1)
+        self.wait(t())
+
+    def test_rollback_keeps_row_cache_clean(self):
+        async def t():
+            b = blog()
+            await b.save()
+            with self.assertRaises(RuntimeError):
+                async with orm.transaction():
+                    x = await Blog.find(b.id)
+                    x.name = 'uncommitted'
+                    await x.update()
+                    self.assertEqual((await Blog.find(b.id)).name, 'uncommitted')
+                    raise RuntimeError()
+            self.assertEqual((await Blog.find(b.id)).name, 'old')
+            self.assertEqual((await Blog.find(b.id)).name, 'old')
+        self.wait(t())
+
+    def test_rollback_keeps_counter_clean(self):
+        async def t():
+            with self.assertRaises(RuntimeError):
+                async with orm.transaction():
+                    await comment().save()
+                    self.assertEqual(await Comment.count(), 1)
+                    raise RuntimeError()
+            self.assertEqual(await Comment.count(), 0)
+        self.wait(t())
+
+class TestQueryStats(OrmTestCase):
+
+    def test_normalize(self):
+        self.assertEqual(orm.normalize('delete from `t` where `id` in (?, ?, ?)'), 'delete from `t` where `id` in (?, ...)')
+        self.assertEqual(orm.normalize('insert into `t` values (%s, %s), (%s, %s)'), 'insert into `t` values (%s, ...), ...')
+
+    def test_histogram(self):
+        s = orm.QueryStats(slow=None)
+        for t in (0.0005, 0.003, 0.003, 10):
+            s.record('select 1', t, 1, 0)
+        d = s.stats()['statements']['select 1']
+        self.assertEqual((d['count'], d['rows'], sum(d['histogram']), d['histogram'][-1]), (4, 4, 4, 1))
+        self.assertEqual((d['p50'], d['p99']), (0.005, None))
+        self.assertEqual(s.stats()['slow_log'], [])
+
+    def test_slow_log(self):
+        async def t():
+            await orm.close_pool()
+            slow = orm._stats.slow
+            await self.open(slow_query=0)
+            try:
+                await Comment.save_many([comment() for i in range(3)])
+                await Comment.findAll()
+            finally:
+                orm._stats.slow = slow
+            log = orm.query_stats()['slow_log']
+            self.assertIn(3, [e['rows'] for e in log if e['sql'].startswith('select')])
+        self.wait(t())
+
+class TestPoolManager(OrmTestCase):
+
+    pool_args = dict(minsize=1, maxsize=3, shrink_after=0)
+
+    def test_nested_acquire_grows(self):
+        async def t():
+            u = User(name='a', email='e', passwd='p', image='i')
+            await u.save()
+            await Comment.save_many([Comment(blog_id='b', user_id=u.id, user_name='a', user_image='i', content='x') for i in range(3)])
+            found = 0
+            async for c in Comment.iter():
+                found += (await User.find(c.user_id)) is not None
+            self.assertEqual(found, 3)
+            self.assertEqual(orm.pool_stats()['primary']['peak'], 2)
+        self.wait(t())
+
+    def test_shrink(self):
+        async def t():
+            async def hold():
+                async with orm.transaction():
+                    await asyncio.sleep(0.05)
+            await asyncio.gather(hold(), hold())
+            # 释放后立即收缩, 多余的空闲连接在后台关闭:
+            await asyncio.sleep(0.05)
+            s = orm.pool_stats()['primary']
+            self.assertEqual((s['peak'], s['limit'], s['size']), (2, 1, 1))
+        self.wait(t())
+
+class TestBatcher(OrmTestCase):
+
+    def test_concurrent_finds_share_a_query(self):
+        async def t():
+            us = [User(name='u%d' % i, email='e%d' % i, passwd='p', image='i') for i in range(5)]
+            await User.save_many(us)
+            before = orm.batch_stats()['users']['batches']
+            rs = await asyncio.gather(*[User.find(u.id) for u in us] + [User.find('missing')])
+            self.assertEqual([r.name if r else None for r in rs], ['u0', 'u1', 'u2', 'u3', 'u4', None])
+            self.assertIs(rs[0].admin, False)
+            self.assertEqual(orm.batch_stats()['users']['batches'] - before, 1)
+        self.wait(t())
+
+class TestSchema(OrmTestCase):
+
+    def test_created_indexes_present(self):
+        self.assertEqual(self.wait(orm.sync_indexes()), [])
+
+    def test_prefix_satisfies_plain_index(self):
+        async def t():
+            await orm.execute('drop index `comments_idx_blog_id_created_at`', ())
+            await orm.execute('create index `comments_by_blog` on `comments` (`blog_id`, `created_at`, `id`)', ())
+            self.assertEqual(await orm.sync_indexes([Comment]), [])
+        self.wait(t())
+
+    def test_unique_needs_unique_index(self):
+        async def t():
+            await orm.execute('drop index `users_uniq_email`', ())
+            await orm.execute('create index `users_by_email` on `users` (`email`, `name`)', ())
+            await orm.execute('create index `users_email` on `users` (`email`)', ())
+            self.assertEqual(await orm.sync_indexes([User], create=True), [('users', 'uniq_email', ('email',))])
+            self.assertEqual(await orm.sync_indexes([User]), [])
+        self.wait(t())
+
+class TestRowCounter(OrmTestCase):
+
+    def test_adjusted_by_writes(self):
+        async def t():
+            self.assertEqual(await Comment.count(), 0)
+            c = comment()
+            await c.save()
+            await Comment.save_many([comment() for i in range(2)])
+            await c.remove()
+            before = orm.counter_stats()['comments']
+            self.assertEqual(await Comment.count(), 2)
+            s = orm.counter_stats()['comments']
+            self.assertEqual((s['hits'] - before['hits'], s['reconciles'] - before['reconciles']), (1, 0))
+        self.wait(t())
+
+    def test_shared_load_and_reconcile(self):
+        async def t():
+            before = orm.counter_stats()['comments']['reconciles']
+            self.assertEqual(await asyncio.gather(*[Comment.count() for i in range(5)]), [0] * 5)
+            self.assertEqual(orm.counter_stats()['comments']['reconciles'] - before, 1)
+            await orm.execute('insert into `comments` (`id`, `blog_id`, `user_id`, `user_name`, `user_image`, `content`, `created_at`) values (?, ?, ?, ?, ?, ?, ?)', ['x', 'b', 'u', 'a', 'i', 'c', 1.0])
+            self.assertEqual(await Comment.count(), 0) # 其他进程的写入, 对账前不可见
+            counter = Comment.__rowcounter__
+            reconcile, counter.reconcile = counter.reconcile, 0
+            try:
+                self.assertEqual(await Comment.count(), 1)
+            finally:
+                counter.reconcile = reconcile
+        self.wait(t())
+
+class TestUpsert(OrmTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.u = User(name='a', email='e', passwd='p', image='i')
+        self.wait(self.u.save())
+
+    def test_update(self):
+        async def t():
+            self.assertEqual(await User.count(), 1)
+            await User.find(self.u.id) # 进入行缓存
+            v = User(id=self.u.id, name='b', email='e', passwd='q', image='j')
+            self.assertIn(await v.upsert(fields=['name', 'image']), (1, 2))
+            x = await User.find(self.u.id)
+            self.assertEqual((x.name, x.image, x.passwd), ('b', 'j', 'p'))
+            self.assertEqual(await User.count(), 1)
+            self.assertEqual(await User(name='c', email='f', passwd='p', image='i').upsert(), 1)
+            self.assertEqual(await User.count(), 2)
+        self.wait(t())
+
+    def test_ignore(self):
+        async def t():
+            v = User(name='b', email='e', passwd='p', image='i') # 邮箱重复
+            self.assertEqual(await v.save(on_conflict='ignore'), 0)
+            self.assertEqual([u.name for u in await User.findAll()], ['a'])
+            self.assertEqual(await User.count(), 1)
+        self.wait(t())
+
+    def test_invalid(self):
+        with self.assertRaises(ValueError):
+            self.wait(self.u.save(on_conflict='replace'))
+        with self.assertRaises(ValueError):
+            self.wait(self.u.upsert(fields=['missing']))
+
+class TestUpdate(OrmTestCase):
+
+    def test_only_changed_fields(self):
+        async def t():
+            b = blog()
+            await b.save()
+            x = await Blog.find(b.id)
+            self.assertEqual(await x.update(), 0)
+            x.name = 'new'
+            self.assertEqual(await x.update(), 1)
+            self.assertEqual(x._changed, ())
+            self.assertEqual((await Blog.findAll())[0].name, 'new')
+        self.wait(t())
+
+    def test_non_field_change(self):
+        async def t():
+            b = blog()
+            await b.save()
+            x = await Blog.find(b.id)
+            x.html_content = '<p>c</p>'
+            self.assertEqual(await x.update(), 0)
+        self.wait(t())
+
+    def test_copy_keeps_loaded_state(self):
+        async def t():
+            b = blog()
+            await b.save()
+            x = (await Blog.find(b.id)).copy()
+            dict.__setitem__(x, 'summary', '******')
+            x.name = 'new'
+            await x.update()
+            y = (await Blog.findAll())[0]
+            self.assertEqual((y.name, y.summary), ('new', 's'))
+        self.wait(t())
+
+class TestSQLite(OrmTestCase):
+
+    def test_memory_concurrency(self):
+        async def t():
+            await orm.close_pool()
+            await self.open(db=':memory:', minsize=10, maxsize=10)
+            rs = await asyncio.gather(Comment.save_many([comment() for i in range(500)]), Comment.save_many([comment() for i in range(500)]),
+                *[Comment.findAll() for i in range(20)], return_exceptions=True)
+            self.assertEqual([r for r in rs if isinstance(r, Exception)], [])
+            self.assertEqual(await Comment.findNumber('count(id)'), 1000)
+        self.wait(t())
+
+class TestQueryCache(OrmTestCase):
+
+    pool_args = dict(query_cache=dict(ttl=0.1, stale=1))
+
+    def test_invalidated_by_write(self):
+        async def t():
+            await blog('a').save()
+            rs = await asyncio.gather(*[Blog.findAll(cache=True) for i in range(5)])
+            self.assertEqual([len(r) for r in rs], [1] * 5)
+            self.assertEqual(orm.query_cache_stats()['size'], 1)
+            await blog('b').save()
+            self.assertEqual(orm.query_cache_stats()['size'], 0)
+            self.assertEqual(len(await Blog.findAll(cache=True)), 2)
+        self.wait(t())
+
+    def test_stale_while_revalidate(self):
+        async def t():
+            await blog('a').save()
+            await Blog.findAll(cache=True)
+            await asyncio.sleep(0.15)
+            await orm.execute('update `blogs` set `name`=?', ['b'])
+            # 写入后缓存失效, 这里直接读到新值:
+            self.assertEqual((await Blog.findAll(cache=True))[0].name, 'b')
+            await asyncio.sleep(0.15)
+            self.assertEqual((await Blog.findAll(cache=True))[0].name, 'b')
+            self.assertEqual(orm.query_cache_stats()['stale_hits'], 1)
+        self.wait(t())
+
+class TestRelations(OrmTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.u = User(name='a', email='e', passwd='p', image='i')
+        self.wait(self.u.save())
+        self.bs = [blog('b%d' % i) for i in range(3)]
+        for b in self.bs:
+            b.user_id = self.u.id
+        self.wait(Blog.save_many(self.bs))
+        cs = [Comment(blog_id=self.bs[i % 2].id, user_id=self.u.id, user_name='a', user_image='i', content='c%d' % i, created_at=100.0 + i) for i in range(4)]
+        self.wait(Comment.save_many(cs))
+
+    def test_prefetch(self):
+        async def t():
+            bs = await Blog.findAll(orderBy='name', prefetch=['comments.user', 'user'])
+            self.assertEqual([[c.content for c in b.comments] for b in bs], [['c2', 'c0'], ['c3', 'c1'], []])
+            self.assertEqual(set(c.user.name for b in bs for c in b.comments), {'a'})
+            self.assertEqual(bs[0].user.email, 'e')
+        self.wait(t())
+
+    def test_batched(self):
+        async def t():
+            bs = await Blog.findAll()
+            selects = lambda: sum(s['count'] for sql, s in orm.query_stats()['statements'].items() if 'from `comments`' in sql)
+            before = selects()
+            chunk_size, orm.Relation.chunk_size = orm.Relation.chunk_size, 2
+            try:
+                await Blog.prefetch(bs, 'comments')
+            finally:
+                orm.Relation.chunk_size = chunk_size
+            self.assertEqual(sum(len(b.comments) for b in bs), 4)
+            self.assertEqual(selects() - before, 2)
+        self.wait(t())
+
+    def test_find(self):
+        async def t():
+            with orm.pipeline():
+                b, cs = await asyncio.gather(Blog.find(self.bs[1].id), Blog.comments.find(self.bs[1].id))
+            self.assertEqual((b.name, [c.content for c in cs]), ('b1', ['c3', 'c1']))
+        self.wait(t())
+
+    def test_not_loaded(self):
+        async def t():
+            b = await Blog.find(self.bs[0].id)
+            with self.assertRaises(AttributeError):
+                b.comments
+            with self.assertRaises(ValueError):
+                await Blog.findAll(prefetch=['comments'], compact=True)
+        self.wait(t())
+
+class TestGenerated(OrmTestCase):
+
+    def test_converters(self):
+        self.assertEqual(User.__converters__, dict(admin=bool, created_at=float))
+        build = orm.make_builder(User, ('id', 'admin', 'created_at'), converters=User.__converters__)
+        self.assertEqual(dict(build(('1', 1, None))), dict(id='1', admin=True, created_at=None))
+        row = orm.make_builder(User.__row__, ('id', 'admin'), True, User.__converters__)(('1', 0))
+        self.assertIs(row.admin, False)
+
+    def test_to_args(self):
+        u = User(name='a', email='e', passwd='p', image='i')
+        args = u.insertArgs()
+        self.assertEqual(args[-1], u.id) # 主键在最后, 与__insert__一致
+        self.assertEqual(args[:-1], [u[f] for f in User.__fields__])
+        self.assertIs(u.admin, False)
+        self.assertIsInstance(u.created_at, float)
+        self.assertNotEqual(User(name='b').insertArgs()[-1], u.id)
+
+    def test_load_converts(self):
+        async def t():
+            u = User(name='a', email='e', passwd='p', image='i')
+            await u.save()
+            x = (await User.findAll(fields=['name']))[0]
+            await x.load('admin')
+            self.assertIs(x.admin, False)
+        self.wait(t())
+
+class TestWriteBehind(OrmTestCase):
+
+    def test_batched(self):
+        async def t():
+            cs = [comment() for i in range(250)]
+            await asyncio.gather(*[c.save_later() for c in cs])
+            self.assertTrue(all(c.id for c in cs))
+            await orm.close_pool()
+            await self.open()
+            self.assertEqual(await Comment.findNumber('count(id)'), 250)
+        self.wait(t())
+
+    def test_replay(self):
+        async def t():
+            cs = [comment('x%d' % i) for i in range(4)]
+            await Comment.save_many(cs[:2])
+            line = lambda c: json.dumps(dict((k, c.get(k)) for k in Comment.__mappings__)) + '\n'
+            spill = Comment.__writer__.spill
+            # 上次replay中断留下的文件, 以及关闭时溢出的已提交批次:
+            with open(spill + '.replay', 'w') as f:
+                f.write(line(cs[0]) + line(cs[2]))
+            with open(spill, 'w') as f:
+                f.write(line(cs[1]) + line(cs[3]))
+            await orm.close_pool()
+            await self.open()
+            self.assertEqual(await Comment.findNumber('count(id)'), 4)
+            self.assertFalse(os.path.exists(spill) or os.path.exists(spill + '.replay'))
+        self.wait(t())
+
+class TestPipeline(OrmTestCase):
+
+    def test_one_round_trip(self):
+        async def t():
+            b = blog()
+            await b.save()
+            await Comment.save_many([comment() for i in range(3)])
+            with orm.pipeline() as p:
+                n, bs, x, m = await asyncio.gather(Comment.count(), Blog.findAll(cache=True), Blog.find(b.id), Comment.findNumber('max(created_at)'))
+            self.assertEqual((n, [y.name for y in bs], x.name), (3, ['old'], 'old'))
+            self.assertIsInstance(m, float)
+            self.assertEqual((p.round_trips, p.statements), (1, 4))
+        self.wait(t())
+
+    def test_sequential(self):
+        async def t():
+            with orm.pipeline() as p:
+                await Blog.findAll()
+                await Comment.findAll()
+            self.assertEqual((p.round_trips, p.statements), (2, 2))
+            with orm.pipeline() as p:
+                async with orm.transaction():
+                    await asyncio.gather(Blog.findAll(), Comment.findAll())
+            self.assertEqual(p.round_trips, 0)
+        self.wait(t())
+
+    def test_error(self):
+        async def t():
+            with orm.pipeline():
+                rs = await asyncio.gather(Blog.findAll(), orm.select('select * from `missing`', []), return_exceptions=True)
+            self.assertIsInstance(rs[1], Exception)
+            self.assertEqual(await Blog.findAll(), [])
+        self.wait(t())
+
+if __name__ == '__main__':
+    unittest.main()